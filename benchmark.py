@@ -0,0 +1,410 @@
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime, timedelta
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import udf, col, broadcast, element_at, array, lit, floor, rand
+
+import etl
+import generate_data
+from instrumentation import instrument, get_output_summary
+
+
+def create_local_spark_session():
+    """
+        Create and return local Apache Spark session used to run benchmarks
+    Returns:
+        spark(object): Spark session
+    """
+
+    spark = SparkSession.builder \
+                        .master('local[*]') \
+                        .appName('nd-de-benchmark') \
+                        .getOrCreate()
+
+    print('\nLocal Spark session started')
+
+    return spark
+
+
+def time_action(action):
+    """
+    This function:
+        Run action and measure its wall time
+    Paramters:
+        action (function) - function without parameters to run
+    Returns:
+        tuple of action result and elapsed seconds
+    """
+
+    start = time.perf_counter()
+    result = action()
+
+    return result, time.perf_counter() - start
+
+
+def get_synthetic_sas_dates(spark, row_count):
+    """
+    This function:
+        Create synthetic dataframe with SAS arrival and departure dates for April 2016
+    Paramters:
+        spark (object) - Spark session
+        row_count (int) - number of rows to generate
+    Returns:
+        dataframe with columns id, arrdate, depdate (SAS dates as double)
+    """
+
+    return spark.range(row_count) \
+                .withColumn('arrdate', (col('id') % 30 + 20545).cast('double')) \
+                .withColumn('depdate', (col('id') % 30 + 20545 + col('id') % 17).cast('double'))
+
+
+def benchmark_fact_date_udfs(spark, row_count=1000000):
+    """
+    This function:
+        Compare run time of native date/stay computation with the former Python UDFs, parity of their results is
+        checked by tests/test_date_functions.py
+    Paramters:
+        spark (object) - Spark session
+        row_count (int) - number of rows in synthetic dataframe
+    """
+
+    print('\nStart of benchmark_fact_date_udfs on {} rows'.format(row_count))
+
+    #former row-at-a-time Python UDFs used in build_fact_i94_visits
+    legacy_get_date_from_sas = udf(lambda x: (datetime(1960, 1, 1).date() + timedelta(x)).isoformat() if x else None)
+    legacy_get_stay = udf(lambda x, y: int(x - y))
+
+    df_dates = get_synthetic_sas_dates(spark, row_count).cache()
+    df_dates.count()
+
+    df_legacy = df_dates.withColumn('stay', legacy_get_stay(df_dates.depdate, df_dates.arrdate)) \
+                        .withColumn('arrdate', legacy_get_date_from_sas(df_dates.arrdate)) \
+                        .withColumn('depdate', legacy_get_date_from_sas(df_dates.depdate))
+
+    df_native = df_dates.withColumn('stay', etl.get_stay(df_dates.depdate, df_dates.arrdate)) \
+                        .withColumn('arrdate', etl.get_date_from_sas('arrdate')) \
+                        .withColumn('depdate', etl.get_date_from_sas('depdate'))
+
+    _, legacy_seconds = time_action(lambda: df_legacy.groupBy('arrdate').agg({'stay': 'max'}).collect())
+    _, native_seconds = time_action(lambda: df_native.groupBy('arrdate').agg({'stay': 'max'}).collect())
+
+    print('Legacy Python UDFs: {:.2f} s'.format(legacy_seconds))
+    print('Native JVM expressions: {:.2f} s'.format(native_seconds))
+
+    df_dates.unpersist()
+
+    print('End of benchmark_fact_date_udfs')
+
+
+def get_plan_size(df):
+    """
+    This function:
+        Get size of optimized logical plan of dataframe
+    Paramters:
+        df (dataframe) - dataframe
+    Returns:
+        number of characters of optimized plan
+    """
+
+    return len(df._jdf.queryExecution().optimizedPlan().toString())
+
+
+def benchmark_port_filter(spark, row_count=1000000):
+    """
+    This function:
+        Compare plan size and throughput of isin() literal list and broadcast semi-join for valid port filtering
+    Paramters:
+        spark (object) - Spark session
+        row_count (int) - number of rows in synthetic dataframe
+    """
+
+    print('\nStart of benchmark_port_filter on {} rows'.format(row_count))
+
+    port_codes = list(etl.get_us_ports('map/I94-us_ports.txt', 'map/I94-us_states.txt')['code'])
+    test_codes = port_codes + ['XXX', 'YYY', 'ZZZ']
+
+    df_i94 = spark.range(row_count) \
+                  .withColumn('i94port', element_at(array(*[lit(code) for code in test_codes]), (floor(rand(42) * len(test_codes)) + 1).cast('int'))) \
+                  .cache()
+    df_i94.count()
+
+    df_isin = df_i94.filter(df_i94.i94port.isin(port_codes))
+
+    df_valid_ports = etl.get_us_ports_reference(spark, 'map/I94-us_ports.txt', 'map/I94-us_states.txt')
+    df_semi_join = df_i94.join(broadcast(df_valid_ports), df_i94.i94port == df_valid_ports.code, how='left_semi')
+
+    isin_count, isin_seconds = time_action(df_isin.count)
+    semi_join_count, semi_join_seconds = time_action(df_semi_join.count)
+
+    if isin_count != semi_join_count:
+        raise ValueError('Semi-join returned {} rows, isin returned {} rows'.format(semi_join_count, isin_count))
+
+    print('isin literal list: plan size {} chars, {:.2f} s, {:.0f} rows/s'.format(get_plan_size(df_isin), isin_seconds, row_count / isin_seconds))
+    print('broadcast semi-join: plan size {} chars, {:.2f} s, {:.0f} rows/s'.format(get_plan_size(df_semi_join), semi_join_seconds, row_count / semi_join_seconds))
+
+    df_i94.unpersist()
+
+    print('End of benchmark_port_filter')
+
+
+def run_pipeline_once(spark, data_sources, first_month, last_month):
+    """
+    This function:
+        Run each etl stage once, sequentially, and collect its instrumentation record
+    Paramters:
+        spark (object) - Spark session
+        data_sources (list) - I94 immigration data sources
+        first_month (string) - first month in yyyy-mm format
+        last_month (string) - last month in yyyy-mm format
+    Returns:
+        list of instrumentation records
+    """
+
+    stages = [
+        ('stage_i94_immigration', lambda: etl.stage_i94_months(spark, data_sources, 'stage_i94_immigration')),
+        ('stage_city_temperatures', lambda: etl.stage_city_temperature_data(spark, 'city_temperature.csv', 'stage_city_temperatures', first_month, last_month)),
+        ('dim_us_ports', lambda: etl.load_dim_us_ports(spark, 'map/I94-us_ports.txt', 'map/I94-us_states.txt', 'dim_us_ports')),
+        ('fact_i94_visits', lambda: etl.build_fact_i94_visits(spark, 'stage_i94_immigration', 'stage_city_temperatures', 'dim_us_ports', 'fact_i94_visits')),
+        ('dim_date', lambda: etl.load_dim_date(spark, 'fact_i94_visits', 'dim_date')),
+        ('agg_state_city_arrivals', lambda: etl.build_agg_state_city_arrivals(spark, 'fact_i94_visits', 'dim_us_ports', 'agg_state_city_arrivals')),
+        ('quality_checks', lambda: etl.run_pipeline_quality_checks(spark, first_month, last_month, True)),
+        ('query:get_top_10_warmest_cities', lambda: etl.get_top_10_warmest_cities(spark, 'fact_i94_visits', 'dim_us_ports', 'CA'))
+    ]
+
+    records = []
+    for name, action in stages:
+        output_paths = [os.path.join(etl.output_data, name)] if not name.startswith(('query:', 'quality')) else []
+        with instrument(spark, name, output_paths) as record:
+            action()
+        records.append(record)
+
+    return records
+
+
+def benchmark_scaling(spark, work_folder, base_rows=100000, scales=(1, 10, 100), first_month='2016-04', last_month='2016-04'):
+    """
+    This function:
+        Run the pipeline on synthetic data at several scales and report throughput of each stage
+    Paramters:
+        spark (object) - Spark session
+        work_folder (string) - folder for generated input and pipeline output, it is replaced
+        base_rows (int) - number of unique I94 records per month at scale 1
+        scales (tuple) - scale factors
+        first_month (string) - first month in yyyy-mm format
+        last_month (string) - last month in yyyy-mm format
+    Returns:
+        list of results with scale, stage, wall time, input records and throughput
+    """
+
+    print('\nStart of benchmark_scaling at scales {}'.format(scales))
+
+    #months staged concurrently write their own partitions, as in etl main
+    spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+
+    #pipeline reads mapping files and generated temperatures from input folder and writes into output folder
+    original_input_data, original_output_data = etl.input_data, etl.output_data
+
+    results = []
+    try:
+        for scale in scales:
+            scale_folder = os.path.join(work_folder, 'x{}'.format(scale))
+            shutil.rmtree(scale_folder, ignore_errors=True)
+            shutil.copytree(os.path.join(original_input_data, 'map'), os.path.join(scale_folder, 'input', 'map'))
+
+            etl.input_data = os.path.join(scale_folder, 'input')
+            etl.output_data = os.path.join(scale_folder, 'output')
+
+            data_sources = generate_data.generate_dataset(spark, etl.input_data, first_month, last_month, base_rows * scale, world_scale=10 * scale)
+
+            for record in run_pipeline_once(spark, data_sources, first_month, last_month):
+                input_records = record['metrics'].get('inputRecords', 0)
+                results.append({'scale': scale,
+                                'stage': record['name'],
+                                'wall_seconds': record['wall_seconds'],
+                                'input_records': input_records,
+                                'records_per_second': round(input_records / record['wall_seconds']) if record['wall_seconds'] else None,
+                                'shuffle_bytes': record['metrics'].get('shuffleWriteBytes', 0),
+                                'outputs': record['outputs']})
+    finally:
+        etl.input_data, etl.output_data = original_input_data, original_output_data
+
+    print('\n{:>6} {:<36} {:>10} {:>14} {:>14}'.format('scale', 'stage', 'seconds', 'input rows', 'rows/s'))
+    for result in results:
+        print('{:>6} {:<36} {:>10.2f} {:>14} {:>14}'.format(result['scale'], result['stage'], result['wall_seconds'], 
+                                                            result['input_records'], result['records_per_second'] or ''))
+
+    with open(os.path.join(work_folder, 'scaling_report.json'), 'w') as file:
+        json.dump(results, file, indent=2, default=str)
+
+    print('End of benchmark_scaling')
+
+    return results
+
+
+def benchmark_fact_layout(spark, work_folder, row_count=1000000, month='2016-04', bucket_count=8):
+    """
+    This function:
+        Compare bytes scanned by sample queries on fact table written without clustering, sorted by port and bucketed by port
+    Paramters:
+        spark (object) - Spark session
+        work_folder (string) - folder for generated input and pipeline output, it is replaced
+        row_count (int) - number of unique I94 records
+        month (string) - generated month in yyyy-mm format
+        bucket_count (int) - number of buckets of bucketed layout
+    Returns:
+        list of results with layout, query, wall time, input bytes and fact table files
+    """
+
+    print('\nStart of benchmark_fact_layout on {} rows'.format(row_count))
+
+    layouts = [('unsorted', [], 0), ('sorted', ['port_key'], 0), ('bucketed', ['port_key'], bucket_count)]
+
+    original_input_data, original_output_data = etl.input_data, etl.output_data
+    original_layout = etl.fact_sort_columns, etl.fact_bucket_count
+
+    results = []
+    try:
+        shutil.rmtree(work_folder, ignore_errors=True)
+        shutil.copytree(os.path.join(original_input_data, 'map'), os.path.join(work_folder, 'input', 'map'))
+
+        etl.input_data = os.path.join(work_folder, 'input')
+        etl.output_data = os.path.join(work_folder, 'output')
+
+        data_sources = generate_data.generate_dataset(spark, etl.input_data, month, month, row_count)
+
+        etl.stage_i94_months(spark, data_sources, 'stage_i94_immigration')
+        etl.stage_city_temperature_data(spark, 'city_temperature.csv', 'stage_city_temperatures', month, month)
+        etl.load_dim_us_ports(spark, 'map/I94-us_ports.txt', 'map/I94-us_states.txt', 'dim_us_ports')
+
+        for layout, sort_columns, layout_bucket_count in layouts:
+            fact_table = 'fact_{}'.format(layout)
+            etl.fact_sort_columns, etl.fact_bucket_count = sort_columns, layout_bucket_count
+            etl.build_fact_i94_visits(spark, 'stage_i94_immigration', 'stage_city_temperatures', 'dim_us_ports', fact_table)
+
+            #aggregate table does not exist, so queries read the fact table
+            queries = [
+                ('get_top_10_warmest_cities', lambda: etl.get_top_10_warmest_cities(spark, fact_table, 'dim_us_ports', 'CA', '_no_agg_table')),
+                ('get_top_10_warmest_states', lambda: etl.get_top_10_warmest_states(spark, fact_table, 'dim_us_ports', '_no_agg_table'))
+            ]
+            for query, action in queries:
+                with instrument(spark, '{}:{}'.format(layout, query)) as record:
+                    action()
+                results.append({'layout': layout,
+                                'query': query,
+                                'wall_seconds': record['wall_seconds'],
+                                'input_bytes': record['metrics'].get('inputBytes', 0),
+                                'fact_files': get_output_summary(spark, os.path.join(etl.output_data, fact_table))['files']})
+    finally:
+        etl.input_data, etl.output_data = original_input_data, original_output_data
+        etl.fact_sort_columns, etl.fact_bucket_count = original_layout
+
+    print('\n{:<10} {:<28} {:>10} {:>14} {:>10}'.format('layout', 'query', 'seconds', 'input bytes', 'files'))
+    for result in results:
+        print('{:<10} {:<28} {:>10.2f} {:>14} {:>10}'.format(result['layout'], result['query'], result['wall_seconds'],
+                                                          result['input_bytes'], result['fact_files']))
+
+    with open(os.path.join(work_folder, 'fact_layout_report.json'), 'w') as file:
+        json.dump(results, file, indent=2, default=str)
+
+    print('End of benchmark_fact_layout')
+
+    return results
+
+
+def benchmark_stage_schema(spark, work_folder, row_count=1000000, month='2016-04'):
+    """
+    This function:
+        Compare size of I94 stage table and bytes read by fact build with all source columns and with declared stage schema
+    Paramters:
+        spark (object) - Spark session
+        work_folder (string) - folder for generated input and pipeline output, it is replaced
+        row_count (int) - number of unique I94 records
+        month (string) - generated month in yyyy-mm format
+    Returns:
+        list of results with stage schema, stage table size and fact build input bytes
+    """
+
+    print('\nStart of benchmark_stage_schema on {} rows'.format(row_count))
+
+    original_input_data, original_output_data = etl.input_data, etl.output_data
+    original_schema = etl.STAGE_I94_SCHEMA
+
+    results = []
+    try:
+        shutil.rmtree(work_folder, ignore_errors=True)
+        shutil.copytree(os.path.join(original_input_data, 'map'), os.path.join(work_folder, 'input', 'map'))
+
+        etl.input_data = os.path.join(work_folder, 'input')
+        etl.output_data = os.path.join(work_folder, 'output')
+
+        data_sources = generate_data.generate_dataset(spark, etl.input_data, month, month, row_count)
+        etl.stage_city_temperature_data(spark, 'city_temperature.csv', 'stage_city_temperatures', month, month)
+        etl.load_dim_us_ports(spark, 'map/I94-us_ports.txt', 'map/I94-us_states.txt', 'dim_us_ports')
+
+        #former stage schema keeps every source column with its source data type
+        source_schema = {field.name: field.dataType.simpleString() for field in spark.read.parquet(data_sources[0]).schema.fields
+                         if field.name != 'matflag'}
+
+        for schema_name, stage_schema in [('all_columns', source_schema), ('declared', original_schema)]:
+            stage_table = 'stage_i94_{}'.format(schema_name)
+            etl.STAGE_I94_SCHEMA = stage_schema
+            etl.stage_i94_months(spark, data_sources, stage_table)
+
+            with instrument(spark, 'fact_i94_visits:{}'.format(schema_name)) as record:
+                etl.build_fact_i94_visits(spark, stage_table, 'stage_city_temperatures', 'dim_us_ports', 'fact_{}'.format(schema_name))
+
+            stage_summary = get_output_summary(spark, os.path.join(etl.output_data, stage_table))
+            results.append({'stage_schema': schema_name,
+                            'stage_files': stage_summary['files'],
+                            'stage_bytes': stage_summary['bytes'],
+                            'fact_build_input_bytes': record['metrics'].get('inputBytes', 0),
+                            'fact_build_seconds': record['wall_seconds']})
+    finally:
+        etl.input_data, etl.output_data = original_input_data, original_output_data
+        etl.STAGE_I94_SCHEMA = original_schema
+
+    print('\n{:<12} {:>14} {:>18} {:>10}'.format('schema', 'stage bytes', 'fact input bytes', 'seconds'))
+    for result in results:
+        print('{:<12} {:>14} {:>18} {:>10.2f}'.format(result['stage_schema'], result['stage_bytes'], result['fact_build_input_bytes'],
+                                                    result['fact_build_seconds']))
+
+    with open(os.path.join(work_folder, 'stage_schema_report.json'), 'w') as file:
+        json.dump(results, file, indent=2, default=str)
+
+    print('End of benchmark_stage_schema')
+
+    return results
+
+
+def main():
+    """
+    This function:
+        Run benchmarks on local Spark session
+    Args:
+        benchmark name ('micro', 'scaling', 'layout' or 'stage_schema'), row count of synthetic data and work folder, all optional command line arguments
+    """
+
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else 'micro'
+    row_count = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    spark = create_local_spark_session()
+
+    if benchmark == 'micro':
+        benchmark_fact_date_udfs(spark, row_count or 1000000)
+        benchmark_port_filter(spark, row_count or 1000000)
+    elif benchmark == 'scaling':
+        benchmark_scaling(spark, sys.argv[3] if len(sys.argv) > 3 else 'benchmark_output', row_count or 100000)
+    elif benchmark == 'layout':
+        benchmark_fact_layout(spark, sys.argv[3] if len(sys.argv) > 3 else 'benchmark_output', row_count or 1000000)
+    elif benchmark == 'stage_schema':
+        benchmark_stage_schema(spark, sys.argv[3] if len(sys.argv) > 3 else 'benchmark_output', row_count or 1000000)
+    else:
+        raise ValueError('Unknown benchmark "{}"'.format(benchmark))
+
+    spark.stop()
+
+if __name__ == "__main__":
+    main()
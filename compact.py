@@ -0,0 +1,35 @@
+import sys
+
+import etl
+
+
+#tables written by the pipeline, compacted when no table is given on command line
+TABLES = ['stage_i94_immigration', 'stage_city_temperatures', 'dim_countries', 'dim_travel_modes', 'dim_us_visas', 'dim_us_ports',
+          'fact_i94_visits', 'dim_date', 'agg_state_city_arrivals']
+
+
+def main():
+    """
+    This function:
+        Compact existing output tables into files of about TARGET_FILE_SIZE_MB
+    Args:
+        names of tables (folders in OUTPUT_DATA) to compact, all pipeline tables if not set
+    """
+
+    table_names = sys.argv[1:] or TABLES
+
+    spark = etl.create_spark_session()
+
+    for table_name in table_names:
+        if etl.get_table_fingerprint(spark, table_name) is None:
+            print('\nTable "{}" not found, skipping'.format(table_name))
+            continue
+        if table_name == 'fact_i94_visits':
+            etl.compact_table(spark, table_name, sort_columns=etl.fact_sort_columns, options=etl.get_fact_write_options())
+        else:
+            etl.compact_table(spark, table_name)
+
+    spark.stop()
+
+if __name__ == "__main__":
+    main()
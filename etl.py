@@ -1,10 +1,26 @@
+import calendar
 import configparser
+import json
+import math
 import os
+import sys
+import threading
+import time
 import pandas as pd
-import re
+import pyspark
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, year, month, dayofmonth, hour, weekofyear, date_format, upper, avg, count, desc, round
+from urllib.parse import unquote
+from pyspark.sql import SparkSession, Row
+from pyspark.sql.types import StructType
+from pyspark.sql.utils import AnalysisException
+from instrumentation import instrument, get_run_report_json, get_output_summary, record_session_startup
+from pipeline import Stage, run_pipeline
+from quality import run_quality_checks, raise_on_failure
+from sas_reader import convert_sas_to_parquet
+from sketches import build_sketches, get_approximate_arrivals
+from pyspark.sql.functions import broadcast, col, year, month, dayofmonth, weekofyear, date_format, upper, count, desc, round as round_, expr, sum as sum_, to_date, concat_ws, when, hash as hash_, countDistinct
 
 config = configparser.ConfigParser()
 config.read('project.cfg')
@@ -15,26 +31,924 @@ os.environ['AWS_SECRET_ACCESS_KEY']=config.get('AWS','AWS_SECRET_ACCESS_KEY')
 input_data= config.get('PATH', 'INPUT_DATA')
 output_data= config.get('PATH', 'OUTPUT_DATA')
 
+load_mode = config.get('ETL', 'LOAD_MODE', fallback='full')
+manifest_folder = config.get('ETL', 'MANIFEST_FOLDER', fallback='_manifest')
+intermediate_storage = config.get('ETL', 'INTERMEDIATE_STORAGE', fallback='persist')
+checkpoint_dir = config.get('ETL', 'CHECKPOINT_DIR', fallback='')
+schema_folder = config.get('ETL', 'SCHEMA_FOLDER', fallback='_schemas')
+dedup_key = [column.strip() for column in config.get('ETL', 'DEDUP_KEY', fallback='cicid').split(',')]
+key_index_folder = config.get('ETL', 'KEY_INDEX_FOLDER', fallback='_key_index')
 
-def create_spark_session():
+start_month = config.get('ETL', 'START_MONTH', fallback='2016-04')
+end_month = config.get('ETL', 'END_MONTH', fallback='2016-04')
+i94_data_folder = config.get('ETL', 'I94_DATA_FOLDER', fallback='../../data/18-83510-I94-Data-2016/')
+i94_file_pattern = config.get('ETL', 'I94_FILE_PATTERN', fallback='i94_{month}{year}_sub.sas7bdat')
+max_concurrent_months = config.getint('ETL', 'MAX_CONCURRENT_MONTHS', fallback=4)
+scheduler_pool = config.get('ETL', 'SCHEDULER_POOL', fallback='i94_months')
+pipeline_state_file = config.get('ETL', 'PIPELINE_STATE_FILE', fallback='_pipeline_state.json')
+max_concurrent_stages = config.getint('ETL', 'MAX_CONCURRENT_STAGES', fallback=4)
+collect_stage_metrics = config.getboolean('ETL', 'COLLECT_STAGE_METRICS', fallback=True)
+run_report_folder = config.get('ETL', 'RUN_REPORT_FOLDER', fallback='_run_reports')
+target_file_size_mb = config.getint('ETL', 'TARGET_FILE_SIZE_MB', fallback=128)
+fact_sort_columns = [column.strip() for column in config.get('ETL', 'FACT_SORT_COLUMNS', fallback='port_key').split(',') if column.strip()]
+fact_bucket_count = config.getint('ETL', 'FACT_BUCKET_COUNT', fallback=0)
+fact_row_group_size_mb = config.getint('ETL', 'FACT_ROW_GROUP_SIZE_MB', fallback=16)
+sas_reader = config.get('ETL', 'SAS_READER', fallback='spark')
+sas_chunk_size = config.getint('ETL', 'SAS_CHUNK_SIZE', fallback=200000)
+sas_parquet_folder = config.get('ETL', 'SAS_PARQUET_FOLDER', fallback='sas_parquet/')
+temperature_parquet_folder = config.get('ETL', 'TEMPERATURE_PARQUET_FOLDER', fallback='')
+skew_join_enabled = config.getboolean('ETL', 'SKEW_JOIN_ENABLED', fallback=True)
+skew_sample_fraction = config.getfloat('ETL', 'SKEW_SAMPLE_FRACTION', fallback=0.01)
+skew_hot_key_share = config.getfloat('ETL', 'SKEW_HOT_KEY_SHARE', fallback=0.01)
+build_sketches_enabled = config.getboolean('ETL', 'BUILD_SKETCHES', fallback=False)
+query_mode = config.get('ETL', 'QUERY_MODE', fallback='exact')
+query_refresh_seconds = config.getfloat('ETL', 'QUERY_REFRESH_SECONDS', fallback=60)
+sketch_eps = config.getfloat('ETL', 'SKETCH_EPS', fallback=0.001)
+sketch_confidence = config.getfloat('ETL', 'SKETCH_CONFIDENCE', fallback=0.99)
+sketch_distinct_rsd = config.getfloat('ETL', 'SKETCH_DISTINCT_RSD', fallback=0.02)
+sketch_quantile_accuracy = config.getint('ETL', 'SKETCH_QUANTILE_ACCURACY', fallback=10000)
+sketch_sample_fraction = config.getfloat('ETL', 'SKETCH_SAMPLE_FRACTION', fallback=0.05)
+
+s3_committer = config.get('S3', 'COMMITTER', fallback='magic')
+s3_packages = config.get('S3', 'PACKAGES', fallback='')
+s3_multipart_size = config.get('S3', 'MULTIPART_SIZE', fallback='128M')
+s3_fast_upload_buffer = config.get('S3', 'FAST_UPLOAD_BUFFER', fallback='disk')
+s3_fast_upload_active_blocks = config.getint('S3', 'FAST_UPLOAD_ACTIVE_BLOCKS', fallback=8)
+s3_connection_maximum = config.getint('S3', 'CONNECTION_MAXIMUM', fallback=200)
+s3_threads_max = config.getint('S3', 'THREADS_MAX', fallback=64)
+s3_endpoint = config.get('S3', 'ENDPOINT', fallback='')
+s3_path_style_access = config.getboolean('S3', 'PATH_STYLE_ACCESS', fallback=False)
+commit_manifest_folder = config.get('S3', 'COMMIT_MANIFEST_FOLDER', fallback='_commits')
+
+spark_profile = config.get('SPARK', 'PROFILE', fallback='batch')
+spark_jars = config.get('SPARK', 'JARS', fallback='')
+spark_ivy_cache = config.get('SPARK', 'IVY_CACHE', fallback='')
+
+#Spark settings of session profiles are read case sensitive
+profile_config = configparser.ConfigParser()
+profile_config.optionxform = str
+profile_config.read('project.cfg')
+
+#appends to the same table from concurrent jobs share one temporary folder, so they are serialized
+append_lock = threading.Lock()
+
+#columns kept in I94 stage table with their data types, SAS doubles are cast to the smallest integer types holding their values
+#codes and SAS dates (days since 1960-01-01) are integers, port and visa type stay strings, parquet dictionary encodes them
+STAGE_I94_SCHEMA = {'cicid': 'bigint', 'arrdate': 'int', 'depdate': 'int', 'i94port': 'string', 'i94cit': 'smallint', 
+                    'i94mode': 'tinyint', 'i94visa': 'tinyint', 'visatype': 'string'}
+
+#schema of city_temperature.csv, column names are lower case, header line is skipped
+TEMPERATURE_SCHEMA = 'region string, country string, state string, city string, month int, day int, year int, avgtemperature double'
+
+#expected schema of every table produced by main, additional columns in a table are allowed
+EXPECTED_SCHEMAS = {
+    'stage_i94_immigration': STAGE_I94_SCHEMA,
+    'stage_city_temperatures': {'country': 'string', 'state': 'string', 'city': 'string', 'month': 'int', 'day': 'int', 'year': 'int', 
+                                'avgtemperature': 'double', 'city_key': 'int', 'date_key': 'int'},
+    'dim_countries': {'code': 'bigint', 'name': 'string'},
+    'dim_travel_modes': {'code': 'bigint', 'name': 'string'},
+    'dim_us_visas': {'code': 'bigint', 'name': 'string'},
+    'dim_us_ports': {'code': 'string', 'city': 'string', 'state': 'string', 'state_name': 'string', 'port_key': 'int', 'city_key': 'int'},
+    'dim_date': {'arrdate': 'date', 'date_key': 'int', 'day': 'int', 'weekday': 'string', 'week': 'int', 'month': 'int', 'year': 'int'},
+    'agg_state_city_arrivals': {'state': 'string', 'state_name': 'string', 'city': 'string', 'arrdate': 'date', 'arrivals': 'bigint', 
+                                'temperature_sum': 'double', 'temperature_count': 'bigint'},
+    'fact_i94_visits': {'cicid': 'bigint', 'arrdate': 'date', 'date_key': 'int', 'depdate': 'date', 'stay': 'int', 'port_key': 'int', 'i94cit': 'smallint', 
+                        'i94mode': 'tinyint', 'i94visa': 'tinyint', 'visatype': 'string', 'avgtemperature': 'double'}
+}
+
+
+def get_spark_profile(profile):
+    """
+    This function:
+        Get Spark settings of session profile from section [SPARK_PROFILE:<profile>] of configuration
+    Paramters:
+        profile (string) - profile name, e.g. 'local-dev', 'batch' or 'query'
+    Returns:
+        dictionary of settings by name, Spark configuration keys keep their case
+    """
+    
+    section = 'SPARK_PROFILE:' + profile
+    if not profile_config.has_section(section):
+        raise ValueError('Unknown Spark profile "{}"'.format(profile))
+    
+    return dict(profile_config.items(section))
+
+
+def get_spark_version():
+    """
+    This function:
+        Get version of installed PySpark
+    Returns:
+        tuple of major and minor version numbers
+    """
+
+    return tuple(int(part) for part in pyspark.__version__.split('.')[:2])
+
+
+def get_concurrency(max_workers):
+    """
+    This function:
+        Get number of Python threads submitting Spark jobs concurrently, FAIR scheduler pool and job group are local
+        properties of the submitting thread and stay with it only in pinned thread mode, available since Spark 3.0,
+        so on older Spark jobs are submitted one at a time
+    Paramters:
+        max_workers (int) - configured maximum number of threads
+    Returns:
+        maximum number of threads
+    """
+
+    return max_workers if get_spark_version() >= (3, 0) else 1
+
+
+def is_s3a_path(path):
+    """
+    This function:
+        Check if path is on S3 accessed by the S3A connector
+    Paramters:
+        path (string) - file or folder path
+    Returns:
+        True if path has s3a:// scheme
+    """
+
+    return path.lower().startswith('s3a://')
+
+
+def get_s3a_settings():
+    """
+    This function:
+        Get Spark settings of S3A output from section [S3] of configuration, used when OUTPUT_DATA has s3a:// scheme
+        S3A committer uploads written files as pending multipart uploads and completes them in job commit, so output
+        is neither copied nor renamed, magic committer writes straight to S3, staging committers ('directory',
+        'partitioned') stage files on local disk of executors
+    Returns:
+        dictionary of Spark settings by name
+    """
+
+    settings = {
+        'spark.hadoop.mapreduce.outputcommitter.factory.scheme.s3a': 'org.apache.hadoop.fs.s3a.commit.S3ACommitterFactory',
+        'spark.sql.sources.commitProtocolClass': 'org.apache.spark.internal.io.cloud.PathOutputCommitProtocol',
+        'spark.sql.parquet.output.committer.class': 'org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter',
+        'spark.hadoop.fs.s3a.committer.name': s3_committer,
+        'spark.hadoop.fs.s3a.committer.magic.enabled': str(s3_committer == 'magic').lower(),
+        #save mode overwrite already deletes replaced data before the job, committer only adds files
+        'spark.hadoop.fs.s3a.committer.staging.conflict-mode': 'append',
+        #every file of about TARGET_FILE_SIZE_MB is uploaded in parts of MULTIPART_SIZE while it is written
+        'spark.hadoop.fs.s3a.multipart.size': s3_multipart_size,
+        'spark.hadoop.fs.s3a.multipart.threshold': s3_multipart_size,
+        'spark.hadoop.fs.s3a.fast.upload.buffer': s3_fast_upload_buffer,
+        'spark.hadoop.fs.s3a.fast.upload.active.blocks': str(s3_fast_upload_active_blocks),
+        #job commit completes uploads of all files in parallel, connection pool must not be smaller than thread pool
+        'spark.hadoop.fs.s3a.connection.maximum': str(max(s3_connection_maximum, s3_threads_max)),
+        'spark.hadoop.fs.s3a.threads.max': str(s3_threads_max)
+    }
+
+    #S3 compatible stand-in, e.g. MinIO or moto server
+    if s3_endpoint:
+        settings['spark.hadoop.fs.s3a.endpoint'] = s3_endpoint
+        settings['spark.hadoop.fs.s3a.connection.ssl.enabled'] = str(not s3_endpoint.lower().startswith('http://')).lower()
+    if s3_path_style_access:
+        settings['spark.hadoop.fs.s3a.path.style.access'] = 'true'
+
+    return settings
+
+
+def get_spark_packages(s3a_output):
+    """
+    This function:
+        Get Maven packages of Spark session, built for Spark and Scala version of installed PySpark
+    Paramters:
+        s3a_output (boolean) - output is written to S3 by S3A committer
+    Returns:
+        list of package coordinates
+    """
+
+    spark_version = get_spark_version()
+    scala_version = '2.11' if spark_version < (3, 0) else '2.12' if spark_version < (4, 0) else '2.13'
+
+    packages = []
+    if s3a_output:
+        #committer bindings of spark-hadoop-cloud are published for Spark 3.2 and later
+        if spark_version < (3, 2):
+            raise ValueError('Output on S3A needs Spark 3.2 or later, installed PySpark is {}'.format(pyspark.__version__))
+        packages.extend([package.strip() for package in s3_packages.split(',') if package.strip()] or \
+                        ['org.apache.spark:spark-hadoop-cloud_{}:{}'.format(scala_version, pyspark.__version__)])
+
+    #spark-sas7bdat package is needed only when it reads SAS files, chunked reader works offline
+    if sas_reader == 'spark':
+        if spark_version >= (4, 0):
+            raise ValueError('spark-sas7bdat is not built for Spark {}, set SAS_READER=chunked'.format(pyspark.__version__))
+        packages.append('saurfang:spark-sas7bdat:{}-s_{}'.format('2.0.0' if spark_version < (3, 0) else '3.0.0', scala_version))
+
+    return packages
+
+
+def create_spark_session(profile=None):
+    """
+        Create and return Apache Spark session used to process the data, Spark session already running in this process is reused
+    Paramters:
+        profile (string) - Spark profile, defaults to PROFILE from configuration
+    Returns:
+        spark(object): Spark session
+    """
+    
+    profile = profile or spark_profile
+    start = time.perf_counter()
+    
+    #reuse running session, e.g. query service started after the pipeline, instead of starting another one
+    spark = SparkSession._instantiatedSession
+    if spark is not None and spark.sparkContext._jsc is not None:
+        record_session_startup(profile, time.perf_counter() - start, True)
+        print('\nSpark session reused')
+        return spark
+    
+    #every Python thread gets own JVM thread, so scheduler pools and job groups of concurrent stages and months do not mix,
+    #this is the default since Spark 3.2, the variable must be set before the JVM is started
+    os.environ.setdefault('PYSPARK_PIN_THREAD', 'true')
+    
+    settings = get_spark_profile(profile)
+    master = settings.pop('MASTER', None)
+    hive_support = settings.pop('HIVE_SUPPORT', 'auto')
+    
+    builder = SparkSession.builder.appName('nd-de-capstone-{}'.format(profile))
+    if master:
+        builder = builder.master(master)
+    for key, value in settings.items():
+        builder = builder.config(key, value)
+    
+    #Hive metastore is started only when needed, by default when bucketed fact table has to be kept in catalog between runs
+    if hive_support == 'true' or (hive_support == 'auto' and fact_bucket_count > 0):
+        builder = builder.enableHiveSupport()
+    
+    #output on S3 is committed by S3A committer instead of renames, selected by scheme of OUTPUT_DATA
+    if is_s3a_path(output_data):
+        for key, value in get_s3a_settings().items():
+            builder = builder.config(key, value)
+    
+    packages = get_spark_packages(is_s3a_path(output_data))
+    
+    #vendored jars are used as they are, otherwise packages are resolved once into local Ivy cache
+    if packages and spark_jars:
+        builder = builder.config("spark.jars", spark_jars)
+    elif packages:
+        builder = builder.config("spark.jars.repositories", "https://repos.spark-packages.org/") \
+                         .config("spark.jars.packages", ','.join(packages))
+        if spark_ivy_cache:
+            builder = builder.config("spark.jars.ivy", spark_ivy_cache)
+    
+    spark = builder.getOrCreate()
+    
+    startup_seconds = time.perf_counter() - start
+    record_session_startup(profile, startup_seconds, False)
+    
+    print('\nSpark session started with profile "{}" in {:.1f} s'.format(profile, startup_seconds))
+    
+    return spark
+
+
+def read_manifest(spark, table_name):
+    """
+    This function:
+        Read manifest of source files and partitions already processed into table
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name the manifest belongs to
+    Returns:
+        list of manifest rows with source_file, arrdate and loaded_at, empty list if there is no manifest yet
+    """
+    
+    try:
+        return spark.read.json(os.path.join(output_data, manifest_folder, table_name)).collect()
+    except AnalysisException:
+        return []
+    
+
+def write_manifest(spark, table_name, data_source, partitions):
+    """
+    This function:
+        Append processed source file and its partitions to the table manifest
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name the manifest belongs to
+        data_source (string) - processed source file
+        partitions (list) - arrdate partition values written from source file
+    """
+    
+    loaded_at = datetime.utcnow().isoformat()
+    manifest_rows = [Row(source_file=data_source, arrdate=str(partition), loaded_at=loaded_at) for partition in partitions]
+    
+    if manifest_rows:
+        with append_lock:
+            spark.createDataFrame(manifest_rows).coalesce(1).write.mode('append').json(os.path.join(output_data, manifest_folder, table_name))
+    
+
+def get_manifest_partitions(spark, table_name, data_source):
+    """
+    This function:
+        Get arrdate partitions written into table from source file according to the manifest
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name the manifest belongs to
+        data_source (string) - source file
+    Returns:
+        sorted list of arrdate partition values as strings, empty list if source file was not processed
+    """
+    
+    return sorted(set(row.arrdate for row in read_manifest(spark, table_name) if row.source_file == data_source))
+
+
+def write_text_file(spark, path, text):
+    """
+    This function:
+        Write text file from driver, on any file system supported by Spark
+    Paramters:
+        spark (object) - Spark session
+        path (string) - file path
+        text (string) - file content
+    """
+    
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    file_system = jvm_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    
+    stream = file_system.create(jvm_path, True)
+    stream.write(bytearray(text.encode('utf-8')))
+    stream.close()
+    
+
+def read_text_file(spark, path):
+    """
+    This function:
+        Read text file from driver, local files are read without Spark
+    Paramters:
+        spark (object) - Spark session, not used for local files
+        path (string) - file path
+    Returns:
+        file content, None if file does not exist
+    """
+    
+    if '://' not in path:
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return file.read()
+    
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    file_system = jvm_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    if not file_system.exists(jvm_path):
+        return None
+    
+    stream = file_system.open(jvm_path)
+    text = spark._jvm.org.apache.commons.io.IOUtils.toString(stream, 'UTF-8')
+    stream.close()
+    
+    return text
+
+
+def write_schema_cache(spark, df, table_name):
+    """
+    This function:
+        Write schema of dataframe written into table to the schema cache, it is used by schema checks instead of reading the table
+    Paramters:
+        spark (object) - Spark session
+        df (dataframe) - dataframe written into table
+        table_name (string) - table name
+    """
+    
+    write_text_file(spark, os.path.join(output_data, schema_folder, table_name + '.json'), df.schema.json())
+
+
+def write_commit_manifest(spark, table_name, path, write_seconds):
+    """
+    This function:
+        Write commit manifest of table written to S3, it is taken from the _SUCCESS file where S3A committer lists
+        committed files, rename based committer leaves the _SUCCESS file empty
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name
+        path (string) - table path
+        write_seconds (float) - time of the write including commit
+    Returns:
+        dictionary with committer, commit date, write time and committed files, None if S3A committer was not used
+    """
+
+    success_json = read_text_file(spark, os.path.join(path, '_SUCCESS'))
+    if not success_json:
+        print('\nWARNING: table "{}" was committed by renames, S3A committer is not on classpath or not configured'.format(table_name))
+        return None
+
+    success = json.loads(success_json)
+    manifest = {'table': table_name,
+                'path': path,
+                'committer': success.get('committer'),
+                'committed_at': success.get('date'),
+                'write_seconds': round(write_seconds, 3),
+                'files': success.get('filenames', []),
+                'metrics': success.get('metrics', {})}
+
+    write_text_file(spark, os.path.join(output_data, commit_manifest_folder, table_name + '.json'), json.dumps(manifest, indent=2))
+
+    return manifest
+
+
+def get_records_per_file(df, bytes_per_row=None):
+    """
+    This function:
+        Get maximum number of records per output file, so written files are close to TARGET_FILE_SIZE_MB
+    Paramters:
+        df (dataframe) - dataframe to write
+        bytes_per_row (float) - measured bytes per row of written files, if not set it is estimated from the schema,
+                                the estimate is uncompressed row size, so compressed parquet files stay below the target
+    Returns:
+        number of records per file
+    """
+
+    if not bytes_per_row:
+        bytes_per_row = df._jdf.schema().defaultSize()
+
+    return max(1, int(target_file_size_mb * 1024 * 1024 // max(1, bytes_per_row)))
+
+
+def is_catalog_table(spark, table_name):
+    """
+    This function:
+        Check if table is registered in Spark catalog, only bucketed tables are registered as bucketing is kept in catalog metadata
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name
+    Returns:
+        True if table is registered in catalog
+    """
+
+    return spark.catalog._jcatalog.tableExists(table_name)
+
+
+def read_table(spark, table_name):
+    """
+    This function:
+        Read table, bucketed table is read from catalog so joins and aggregations on bucket column do not shuffle it
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name
+    Returns:
+        dataframe
+    """
+
+    if is_catalog_table(spark, table_name):
+        return spark.table(table_name)
+
+    return spark.read.parquet(os.path.join(output_data, table_name))
+
+
+def write_table(spark, df, table_name, partition_column=None, mode='overwrite', file_count=None, options=None, bytes_per_row=None, path=None, 
+                sort_columns=None, bucket_count=None):
+    """
+    This function:
+        Write dataframe into table as parquet files of about TARGET_FILE_SIZE_MB and write its schema cache
+    Paramters:
+        spark (object) - Spark session
+        df (dataframe) - dataframe to write
+        table_name (string) - table name
+        partition_column (string) - partition column, data are repartitioned by it so every partition folder is written
+                                    by one task instead of every task writing a small file into every folder
+        mode (string) - save mode
+        file_count (int) - number of files of not partitioned table, e.g. 1 for small dimension tables
+        options (dict) - additional writer options
+        bytes_per_row (float) - measured bytes per row, see get_records_per_file
+        path (string) - output path, defaults to table folder in OUTPUT_DATA, output on S3 gets a commit manifest
+        sort_columns (list) - columns rows are sorted by within each file, so parquet row group statistics allow
+                              filters on these columns to skip row groups
+        bucket_count (int) - number of buckets by first sort column, bucketed table is also registered in Spark catalog
+    """
+
+    path = path or os.path.join(output_data, table_name)
+    options = dict(options or {})
+
+    #S3A committers cannot overwrite partitions dynamically, partitioned committer replaces written partitions in job commit instead
+    if is_s3a_path(path) and mode == 'overwrite' and partition_column and not bucket_count \
+       and options.get('partitionOverwriteMode', spark.conf.get('spark.sql.sources.partitionOverwriteMode', 'static')).lower() == 'dynamic':
+        mode = 'append'
+        options.update({'partitionOverwriteMode': 'static', 'fs.s3a.committer.name': 'partitioned', 
+                        'fs.s3a.committer.staging.conflict-mode': 'replace'})
+
+    if file_count:
+        df = df.coalesce(file_count)
+    elif partition_column:
+        df = df.repartition(partition_column)
+
+    if sort_columns:
+        df = df.sortWithinPartitions(*([partition_column] if partition_column else []) + list(sort_columns))
+
+    #large partitions are split into several files of target size
+    writer = df.write.mode(mode).option('maxRecordsPerFile', get_records_per_file(df, bytes_per_row))
+    for key, value in options.items():
+        writer = writer.option(key, value)
+    if partition_column:
+        writer = writer.partitionBy(partition_column)
+
+    start = time.perf_counter()
+    if bucket_count:
+        if options.get('partitionOverwriteMode') == 'dynamic' and is_catalog_table(spark, table_name):
+            #replace only written partitions of existing bucketed table, insertInto matches columns by position
+            df.select(*spark.table(table_name).columns).write.insertInto(table_name, overwrite=True)
+        else:
+            writer.bucketBy(bucket_count, sort_columns[0]).sortBy(*sort_columns).option('path', path).saveAsTable(table_name)
+    else:
+        #table written without bucketing must not be read with stale bucketing metadata
+        if is_catalog_table(spark, table_name):
+            spark.sql('DROP TABLE {}'.format(table_name))
+        writer.parquet(path)
+
+    if is_s3a_path(path):
+        write_commit_manifest(spark, table_name, path, time.perf_counter() - start)
+
+    write_schema_cache(spark, df, table_name)
+
+
+def get_table_schema(spark, table_name):
+    """
+    This function:
+        Get column data types of table from the schema cache, without running any Spark job
+    Paramters:
+        spark (object) - Spark session, not used for cached schema on local file system
+        table_name (string) - table name
+    Returns:
+        dictionary of column data types by column name
+    """
+    
+    schema_json = read_text_file(spark, os.path.join(output_data, schema_folder, table_name + '.json'))
+    
+    if schema_json is not None:
+        schema = StructType.fromJson(json.loads(schema_json))
+    else:
+        #table written without schema cache, resolve schema from parquet metadata
+        schema = spark.read.parquet(os.path.join(output_data, table_name)).schema
+            
+    return {field.name: field.dataType.simpleString() for field in schema.fields}
+
+
+def delete_path(spark, path):
+    """
+    This function:
+        Delete file or folder recursively, on any file system supported by Spark
+    Paramters:
+        spark (object) - Spark session
+        path (string) - path to delete
+    """
+    
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    jvm_path.getFileSystem(spark._jsc.hadoopConfiguration()).delete(jvm_path, True)
+
+
+def get_input_fingerprint(spark, input_name):
+    """
+    This function:
+        Get fingerprint of pipeline stage input
+    Paramters:
+        spark (object) - Spark session
+        input_name (string) - 'file:' followed by file path for source files, otherwise table name
+    Returns:
+        fingerprint string, None if input does not exist
+    """
+    
+    if input_name.startswith('file:'):
+        jvm_path = spark._jvm.org.apache.hadoop.fs.Path(input_name[len('file:'):])
+        file_system = jvm_path.getFileSystem(spark._jsc.hadoopConfiguration())
+        if not file_system.exists(jvm_path):
+            return None
+        status = file_system.getFileStatus(jvm_path)
+        return '{}:{}'.format(status.getModificationTime(), status.getLen())
+    
+    fingerprint = get_table_fingerprint(spark, input_name)
+    
+    return None if fingerprint is None else str(fingerprint)
+
+
+def get_months(first_month, last_month):
+    """
+    This function:
+        Get all months in range
+    Paramters:
+        first_month (string) - first month of range in yyyy-mm format
+        last_month (string) - last month of range in yyyy-mm format
+    Returns:
+        list of (year, month) tuples
+    """
+    
+    first_year, first_month_number = [int(part) for part in first_month.split('-')]
+    last_year, last_month_number = [int(part) for part in last_month.split('-')]
+    
+    return [(month_index // 12, month_index % 12 + 1) for month_index in range(first_year * 12 + first_month_number - 1, last_year * 12 + last_month_number)]
+
+
+def get_date_window(first_month, last_month):
+    """
+    This function:
+        Get first and last day of months range
+    Paramters:
+        first_month (string) - first month of range in yyyy-mm format
+        last_month (string) - last month of range in yyyy-mm format
+    Returns:
+        tuple of first and last day in ISO format
+    """
+    
+    months = get_months(first_month, last_month)
+    last_year, last_month_number = months[-1]
+    
+    return '{}-{:02d}-01'.format(*months[0]), '{}-{:02d}-{:02d}'.format(last_year, last_month_number, calendar.monthrange(last_year, last_month_number)[1])
+
+
+def path_exists(spark, path):
+    """
+    This function:
+        Check if path exists, on any file system supported by Spark
+    Paramters:
+        spark (object) - Spark session
+        path (string) - path to check
+    Returns:
+        True if path exists
+    """
+    
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    
+    return jvm_path.getFileSystem(spark._jsc.hadoopConfiguration()).exists(jvm_path)
+
+
+def discover_i94_data_sources(spark, first_month, last_month):
+    """
+    This function:
+        Find monthly I94 immigration data files for months in range
+    Paramters:
+        spark (object) - Spark session
+        first_month (string) - first month of range in yyyy-mm format
+        last_month (string) - last month of range in yyyy-mm format
+    Returns:
+        list of existing data source paths, months without data file are reported and skipped
+    """
+    
+    data_sources = []
+    for data_year, data_month in get_months(first_month, last_month):
+        data_source = os.path.join(i94_data_folder, i94_file_pattern.format(month=calendar.month_abbr[data_month].lower(), year=str(data_year)[-2:]))
+        if path_exists(spark, data_source):
+            data_sources.append(data_source)
+        else:
+            print('I94 data for {}-{:02d} not found: {}'.format(data_year, data_month, data_source))
+            
+    return data_sources
+
+
+def stage_i94_months(spark, data_sources, table_name, incremental=False, max_workers=None):
+    """
+    This function:
+        Stage monthly I94 immigration data files as concurrent Spark jobs in FAIR scheduler pool
+    Paramters:
+        spark (object) - Spark session
+        data_sources (list) - data source paths
+        table_name (string) - output stage table name
+        incremental (boolean) - incremental load, see stage_i94_immigration_data
+        max_workers (int) - maximum number of months staged concurrently, defaults to MAX_CONCURRENT_MONTHS from configuration,
+                            Spark before 3.0 stages months one at a time, see get_concurrency
+    Returns:
+        dictionary of SAS arrdate partition values by data source
+    """
+    
+    #jobs of months belong to job group of the calling stage, so they are included in its instrumentation
+    job_group = spark.sparkContext.getLocalProperty('spark.jobGroup.id')
+    
+    def stage_month(data_source):
+        spark.sparkContext.setLocalProperty('spark.scheduler.pool', scheduler_pool)
+        spark.sparkContext.setLocalProperty('spark.jobGroup.id', job_group)
+        return stage_i94_immigration_data(spark, data_source, table_name, incremental)
+    
+    #full load replaces whole stage table and key index, months then write their own partitions
+    if not incremental:
+        delete_path(spark, os.path.join(output_data, table_name))
+        delete_path(spark, os.path.join(output_data, key_index_folder, table_name))
+    
+    with ThreadPoolExecutor(max_workers=get_concurrency(max_workers or max_concurrent_months)) as executor:
+        return dict(zip(data_sources, executor.map(stage_month, data_sources)))
+
+
+def convert_sas_date(value):
+    """
+    This function:
+        Convert SAS date value (number of days since 1960-01-01) to date in Python
+    Paramters:
+        value (float or string) - SAS date, e.g. arrdate partition value
+    Returns:
+        date
+    """
+    
+    return datetime(1960, 1, 1).date() + timedelta(int(float(value)))
+
+
+def read_key_index(spark, table_name, key_columns, months):
+    """
+    This function:
+        Read keys already loaded into table for given arrival months from the key index
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name the key index belongs to
+        key_columns (list) - key columns
+        months (list) - arrival months as integers in yyyymm format, only these key index partitions are read
+    Returns:
+        dataframe with key columns, None if there is no key index yet
+    """
+    
+    try:
+        df_keys = spark.read.parquet(os.path.join(output_data, key_index_folder, table_name))
+    except AnalysisException:
+        return None
+    
+    return df_keys.filter(df_keys.month.isin(months)).select(*key_columns)
+
+
+def write_key_index(df, table_name, key_columns):
+    """
+    This function:
+        Append keys of loaded data to the key index, sorted key files partitioned by arrival month,
+        full load deletes the key index before months are staged
+    Paramters:
+        df (dataframe) - loaded data containing key columns and SAS arrdate
+        table_name (string) - table name the key index belongs to
+        key_columns (list) - key columns
+    """
+    
+    df_keys = df.select(*key_columns, date_format(get_date_from_sas('arrdate'), 'yyyyMM').cast('int').alias('month'))
+    
+    df_keys.repartition('month') \
+           .sortWithinPartitions(*key_columns) \
+           .write.mode('append').partitionBy('month').parquet(os.path.join(output_data, key_index_folder, table_name))
+    
+
+def get_table_fingerprint(spark, table_name):
+    """
+    This function:
+        Get fingerprint of written table output, it changes whenever the table is written again
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name
+    Returns:
+        modification time of table commit marker (or table folder if there is no marker) in milliseconds, None if table does not exist
+    """
+    
+    table_path = spark._jvm.org.apache.hadoop.fs.Path(os.path.join(output_data, table_name))
+    file_system = table_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    success_path = spark._jvm.org.apache.hadoop.fs.Path(table_path, '_SUCCESS')
+    
+    if file_system.exists(success_path):
+        return file_system.getFileStatus(success_path).getModificationTime()
+    elif file_system.exists(table_path):
+        return file_system.getFileStatus(table_path).getModificationTime()
+    else:
+        return None
+
+
+def store_intermediate(df, storage=None):
     """
-        Create and return Apache Spark session used to process the data
+    This function:
+        Store intermediate dataframe which is used by more than one action, so its lineage is computed only once
+    Paramters:
+        df (dataframe) - intermediate dataframe
+        storage (string) - 'persist' to cache in memory and disk, 'checkpoint' to write to CHECKPOINT_DIR and cut the lineage,
+                           'none' to keep dataframe lazy, defaults to INTERMEDIATE_STORAGE from configuration
     Returns:
-        spark(object): Spark session
+        stored dataframe, release it with release_intermediate once it is no longer used
     """
     
-    spark = SparkSession.builder \
-                        .config("spark.jars.repositories", "https://repos.spark-packages.org/") \
-                        .config("spark.jars.packages", "saurfang:spark-sas7bdat:2.0.0-s_2.11") \
-                        .enableHiveSupport() \
-                        .getOrCreate()
+    storage = storage or intermediate_storage
     
-    print('\nSpark session started')
+    if storage == 'persist':
+        return df.persist()
+    elif storage == 'checkpoint':
+        return df.checkpoint(eager=True)
+    elif storage == 'none':
+        return df
+    else:
+        raise ValueError('Unknown intermediate storage "{}"'.format(storage))
     
-    return spark
 
+def release_intermediate(df):
+    """
+    This function:
+        Release intermediate dataframe stored by store_intermediate
+    Paramters:
+        df (dataframe) - stored intermediate dataframe
+    """
+    
+    if df.is_cached:
+        df.unpersist()
+        
+
+def get_partition_values(spark, table_name, partition_column):
+    """
+    This function:
+        Get partition values of table from its partition directory listing, without reading any data file
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - partitioned table name
+        partition_column (string) - partition column name
+    Returns:
+        sorted list of partition values as strings, null partition is skipped
+    """
+    
+    table_path = spark._jvm.org.apache.hadoop.fs.Path(os.path.join(output_data, table_name))
+    file_system = table_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    prefix = partition_column + '='
+    
+    partition_values = []
+    for status in file_system.listStatus(table_path):
+        directory_name = status.getPath().getName()
+        if status.isDirectory() and directory_name.startswith(prefix) and directory_name != prefix + '__HIVE_DEFAULT_PARTITION__':
+            partition_values.append(unquote(directory_name[len(prefix):]))
+    
+    return sorted(partition_values)
+
+
+def get_partition_column(spark, table_name):
+    """
+    This function:
+        Get partition column of table from its directory listing
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name
+    Returns:
+        partition column name, None if table is not partitioned
+    """
+
+    table_path = spark._jvm.org.apache.hadoop.fs.Path(os.path.join(output_data, table_name))
+    file_system = table_path.getFileSystem(spark._jsc.hadoopConfiguration())
+
+    for status in file_system.listStatus(table_path):
+        directory_name = status.getPath().getName()
+        if status.isDirectory() and '=' in directory_name:
+            return directory_name.split('=')[0]
+
+    return None
+
+
+def compact_table(spark, table_name, partition_column=None, file_count=None, sort_columns=None, options=None):
+    """
+    This function:
+        Rewrite existing table into files of about TARGET_FILE_SIZE_MB, must not run while the pipeline writes the table
+    Paramters:
+        spark (object) - Spark session
+        table_name (string) - table name, folder in OUTPUT_DATA
+        partition_column (string) - partition column, detected from directory listing if not set
+        file_count (int) - number of files of not partitioned table, computed from table size if not set
+        sort_columns (list) - columns rows are sorted by within each file, see write_table
+        options (dict) - writer options the table is written with by the pipeline, e.g. row group size of fact table
+    Returns:
+        tuple of output summaries before and after compaction, None if table is bucketed
+    """
+
+    print('\nStart of compact_table "{}"'.format(table_name))
+
+    table_path = os.path.join(output_data, table_name)
+    summary_before = get_output_summary(spark, table_path)
+    if summary_before is None:
+        raise ValueError('Table "{}" does not exist'.format(table_name))
+
+    #bucketed table has fixed number of files per partition, it is written at target size by the pipeline
+    if is_catalog_table(spark, table_name):
+        print('Table "{}" is bucketed, skipping'.format(table_name))
+        return None
+
+    partition_column = partition_column or get_partition_column(spark, table_name)
+
+    #read table with cached schema, so partition column keeps its written data type
+    reader = spark.read
+    schema_json = read_text_file(spark, os.path.join(output_data, schema_folder, table_name + '.json'))
+    if schema_json is not None:
+        reader = reader.schema(StructType.fromJson(json.loads(schema_json)))
+    df = reader.parquet(table_path)
+
+    #measured size of rows in written files is used instead of uncompressed estimate
+    row_count = df.count()
+    bytes_per_row = summary_before['bytes'] / row_count if row_count else None
+    if not partition_column and not file_count:
+        file_count = max(1, math.ceil(summary_before['bytes'] / (target_file_size_mb * 1024 * 1024)))
+
+    #write compacted copy next to the table, then replace the table with it
+    compacted_path = table_path.rstrip('/') + '_compacted'
+    delete_path(spark, compacted_path)
+    write_table(spark, df, table_name, partition_column, file_count=file_count, options=dict(options or {}, partitionOverwriteMode='static'),
+                bytes_per_row=bytes_per_row, path=compacted_path, sort_columns=sort_columns)
+
+    delete_path(spark, table_path)
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(compacted_path)
+    if not jvm_path.getFileSystem(spark._jsc.hadoopConfiguration()).rename(jvm_path, spark._jvm.org.apache.hadoop.fs.Path(table_path)):
+        raise ValueError('Compacted table "{}" could not be moved to "{}"'.format(compacted_path, table_path))
 
-def stage_i94_immigration_data(spark, data_source, table_name):
+    summary_after = get_output_summary(spark, table_path)
+
+    print('Table "{}" compacted from {} to {} files, {} to {} bytes'.format(table_name, summary_before['files'], summary_after['files'],
+                                                                             summary_before['bytes'], summary_after['bytes']))
+    print('End of compact_table')
+
+    return summary_before, summary_after
+
+
+def stage_i94_immigration_data(spark, data_source, table_name, incremental=False, \
+                               port_data_source='map/I94-us_ports.txt', state_data_source='map/I94-us_states.txt'):
     """
     This function:
         Load data into Spark session, clean them and write them into stage tables
@@ -42,37 +956,122 @@ def stage_i94_immigration_data(spark, data_source, table_name):
         spark (object) - Spark session
         data_source (string) - data source path
         table_name (string) - output stage table name
+        incremental (boolean) - if True, data source already recorded in the manifest is skipped and only records 
+                                with keys not loaded yet according to the key index are appended
+        port_data_source (string) - path to the data source containing US ports
+        state_data_source (string) - path to the data source containing US states
+    Returns:
+        list of SAS arrdate partition values contained in data source
     """
     
     print('\nStart of stage_i94_immigration_data')
     
-    #load I94 immigration data
-    df_spark_i94 = spark.read.format('com.github.saurfang.sas.spark').load(data_source)
+    if incremental:
+        processed_partitions = get_manifest_partitions(spark, table_name, data_source)
+        if processed_partitions:
+            print('Source "{}" already staged in {} partitions, skipping'.format(data_source, len(processed_partitions)))
+            print('End of stage_i94_immigration_data')
+            return processed_partitions
+    
+    #load I94 immigration data, sources other than sas7bdat (e.g. generated synthetic data) are read as parquet
+    if data_source.endswith('.sas7bdat') and sas_reader == 'chunked':
+        #convert SAS file to parquet chunk by chunk on driver, converted file must be readable by executors
+        parquet_source = os.path.join(sas_parquet_folder, os.path.basename(data_source)[:-len('.sas7bdat')] + '.parquet')
+        row_count = convert_sas_to_parquet(data_source, parquet_source, sas_chunk_size)
+        print('Source "{}" converted to "{}", {} rows'.format(data_source, parquet_source, row_count))
+        df_spark_i94 = spark.read.parquet(parquet_source)
+    elif data_source.endswith('.sas7bdat'):
+        df_spark_i94 = spark.read.format('com.github.saurfang.sas.spark').load(data_source)
+    else:
+        df_spark_i94 = spark.read.parquet(data_source)
     
-    #create dictionary of valid US ports
-    port_re_filter = re.compile(r'\'(.*)\'.*\'(.*)\'')
-    i94_port_dict = {}
-
-    with open(os.path.join(input_data, 'map/I94-us_ports.txt')) as file:
-        for line in file:
-            groups = port_re_filter.search(line)
-            if 'No PORT Code' not in groups[2] and 'Collapsed' not in groups[2]:
-                i94_port_dict[groups[1]] = groups[2]
+    #valid US ports, the same set as in dimension table for US ports
+    df_valid_ports = get_us_ports_reference(spark, port_data_source, state_data_source)
+                
+    #keep only columns of stage schema and columns needed for cleaning, other columns are not read from parquet sources
+    df_spark_i94 = df_spark_i94.select(*list(STAGE_I94_SCHEMA) + [column for column in dedup_key if column not in STAGE_I94_SCHEMA] + ['matflag'])
                 
-    #clean I94 immigration data
-    df_spark_i94_clean = df_spark_i94.dropDuplicates() \
-                                .filter(df_spark_i94.i94port.isin(list(i94_port_dict.keys()))) \
+    #clean I94 immigration data, invalid ports are removed by broadcast semi-join and duplicates are removed by key
+    df_spark_i94_clean = df_spark_i94.join(broadcast(df_valid_ports), df_spark_i94.i94port == df_valid_ports.code, how='left_semi') \
                                 .na.drop(subset=["depdate"]) \
                                 .na.drop(subset=["i94mode"]) \
-                                .na.drop(subset=["matflag"])
+                                .na.drop(subset=["matflag"]) \
+                                .drop('matflag')
+    
+    #cast columns to stage schema before removing duplicates, so less data is shuffled
+    df_spark_i94_clean = df_spark_i94_clean.select(*[df_spark_i94_clean[column].cast(STAGE_I94_SCHEMA[column]).alias(column) \
+                                                     if column in STAGE_I94_SCHEMA else df_spark_i94_clean[column] \
+                                                     for column in df_spark_i94_clean.columns]) \
+                                           .dropDuplicates(dedup_key)
+    
+    #cache cleaned data, it is used to collect partitions, to remove keys loaded by previous runs and to write the stage table and key index
+    df_spark_i94_clean = store_intermediate(df_spark_i94_clean)
+    partitions = sorted(str(row.arrdate) for row in df_spark_i94_clean.select('arrdate').distinct().collect())
+    
+    #full load replaces partitions of data source in stage table and key index
+    df_spark_i94_new = df_spark_i94_clean
+    
+    #on incremental load remove records already loaded by previous runs, only key index partitions of affected months are read
+    if incremental:
+        months = sorted(set(int(convert_sas_date(partition).strftime('%Y%m')) for partition in partitions))
+        df_loaded_keys = read_key_index(spark, table_name, dedup_key, months)
+        if df_loaded_keys is not None:
+            df_spark_i94_new = store_intermediate(df_spark_i94_clean.join(df_loaded_keys, dedup_key, how='left_anti'))
+    
+    #write data to the stage table and keys of loaded data to the key index
+    if incremental:
+        with append_lock:
+            write_table(spark, df_spark_i94_new, table_name, 'arrdate', mode='append')
+            write_key_index(df_spark_i94_new, table_name, dedup_key)
+    else:
+        write_table(spark, df_spark_i94_new, table_name, 'arrdate')
+        #months staged concurrently append to one key index, which shares one temporary folder
+        with append_lock:
+            write_key_index(df_spark_i94_new, table_name, dedup_key)
     
-    #write data to the stage table
-    df_spark_i94_clean.write.mode('overwrite').partitionBy('arrdate').parquet(os.path.join(output_data, table_name))
+    release_intermediate(df_spark_i94_new)
+    release_intermediate(df_spark_i94_clean)
+    
+    if incremental:
+        write_manifest(spark, table_name, data_source, partitions)
     
     print('End of stage_i94_immigration_data')
     
+    return partitions
+    
+    
+def convert_temperature_data(spark, data_source, parquet_folder):
+    """
+    This function:
+        Convert city temperature csv to parquet copy partitioned by country, year and month, conversion is skipped 
+        when parquet copy was already made from the same csv file
+    Paramters:
+        spark (object) - Spark session
+        data_source (string) - csv data source path in INPUT_DATA
+        parquet_folder (string) - parquet copy folder in OUTPUT_DATA
+    Returns:
+        parquet copy path
+    """
+    
+    source_fingerprint = get_input_fingerprint(spark, 'file:' + os.path.join(input_data, data_source))
+    parquet_path = os.path.join(output_data, parquet_folder)
+    fingerprint_path = os.path.join(output_data, parquet_folder.rstrip('/') + '.fingerprint')
+    
+    if path_exists(spark, os.path.join(parquet_path, '_SUCCESS')) and read_text_file(spark, fingerprint_path) == source_fingerprint:
+        return parquet_path
+    
+    print('Converting "{}" to parquet partitioned by country, year and month'.format(data_source))
     
-def stage_city_temperature_data(spark, data_source, table_name):
+    spark.read.options(header='True').schema(TEMPERATURE_SCHEMA).csv(os.path.join(input_data, data_source)) \
+         .repartition('country', 'year', 'month') \
+         .write.mode('overwrite').option('partitionOverwriteMode', 'static').partitionBy('country', 'year', 'month').parquet(parquet_path)
+    write_text_file(spark, fingerprint_path, source_fingerprint)
+    
+    return parquet_path
+    
+
+def stage_city_temperature_data(spark, data_source, table_name, first_month='2016-04', last_month='2016-04', \
+                                port_data_source='map/I94-us_ports.txt', state_data_source='map/I94-us_states.txt'):
     """
     This function:
         Load US city temperature data into Spark session, clean them and write them into stage tables
@@ -80,26 +1079,49 @@ def stage_city_temperature_data(spark, data_source, table_name):
         spark (object) - Spark session
         data_source (string) - data source path
         table_name (string) - output stage table name
+        first_month (string) - first month of loaded period in yyyy-mm format
+        last_month (string) - last month of loaded period in yyyy-mm format
+        port_data_source (string) - path to the data source containing US ports
+        state_data_source (string) - path to the data source containing US states
     """
     
     print('\nStart of stage_city_temperature_data')
     
-    #load city temperature data
-    df_spark_temperature = spark.read.options(header='True', inferSchema='True').csv(os.path.join(input_data, data_source))
-    
-    #convert column names to lower case
-    df_spark_temperature = df_spark_temperature.toDF(*[c.lower() for c in df_spark_temperature.columns])
+    #load city temperature data with declared schema, from parquet copy if configured so only partitions of loaded months are read
+    if temperature_parquet_folder:
+        df_spark_temperature = spark.read.schema(TEMPERATURE_SCHEMA).parquet(convert_temperature_data(spark, data_source, temperature_parquet_folder))
+    else:
+        df_spark_temperature = spark.read.options(header='True').schema(TEMPERATURE_SCHEMA).csv(os.path.join(input_data, data_source))
+    
+    #keep US temperatures of loaded months, filters on partition columns prune partitions of parquet copy
+    df_spark_temperature = df_spark_temperature.filter(df_spark_temperature.country == 'US') \
+                                               .filter((df_spark_temperature.year * 100 + df_spark_temperature.month) \
+                                                       .between(int(first_month.replace('-', '')), int(last_month.replace('-', ''))))
+    
+    #clean city temperature data, duplicates are removed from filtered rows only
+    df_spark_temperature_clean = df_spark_temperature.select('region', 'country', 'state', 'city', 'month', 'day', 'year', 'avgtemperature') \
+                                                .dropDuplicates() \
+                                                .withColumn('state', upper(col('state'))) \
+                                                .withColumn('city', upper(col('city'))) \
+                                                .withColumn('city_key', get_city_key(col('state'), col('city'))) \
+                                                .withColumn('date_key', get_date_key(get_date(col('year'), col('month'), col('day'))))
+    
+    #cache cleaned data, it is used by the city key check and written into the stage table
+    df_spark_temperature_clean = store_intermediate(df_spark_temperature_clean)
+    
+    #hash keys must not collide across temperature cities and port cities, otherwise a port is joined with temperatures of another city
+    df_port_cities = spark.createDataFrame(get_us_ports(port_data_source, state_data_source)[['state_name', 'city']])
+    df_cities = df_spark_temperature_clean.select('state', 'city') \
+                                          .union(df_port_cities.select(upper(df_port_cities.state_name), upper(df_port_cities.city)))
+    key_counts = df_cities.agg(countDistinct('state', 'city').alias('cities'), \
+                               countDistinct(get_city_key(df_cities.state, df_cities.city)).alias('city_keys')).first()
+    if key_counts.cities != key_counts.city_keys:
+        raise ValueError('City keys of temperature and US port cities collide: {}'.format(key_counts.asDict()))
     
-    #clean city temperature data
-    df_spark_temperature_clean = df_spark_temperature.dropDuplicates() \
-                                                .filter(df_spark_temperature.country == 'US') \
-                                                .filter(df_spark_temperature.year == 2016) \
-                                                .filter(df_spark_temperature.month == 4) \
-                                                .withColumn('state', upper(df_spark_temperature.state)) \
-                                                .withColumn('city', upper(df_spark_temperature.city)) \
- 
     #write data to the stage table
-    df_spark_temperature_clean.write.mode('overwrite').parquet(os.path.join(output_data, table_name))
+    write_table(spark, df_spark_temperature_clean, table_name, file_count=1)
+    
+    release_intermediate(df_spark_temperature_clean)
     
     print('End of stage_city_temperature_data')
     
@@ -127,118 +1149,308 @@ def load_dim_countries(spark, country_data_source, country_table_name):
     df_spark_countries = spark.createDataFrame(df_countries)
     
     #write data to the dimension table
-    df_spark_countries.write.mode('overwrite').parquet(os.path.join(output_data, country_table_name))
+    write_table(spark, df_spark_countries, country_table_name, file_count=1)
+    
+    print('End of load_dim_countries')
+
+
+def load_dim_travel_modes(spark, mode_data_source, mode_table_name):
+    """
+    This function:
+        Create and load dimension table for travel modes
+    Paramters:
+        spark (object) - Spark session
+        mode_data_source (string) - path to the data source containing travel modes
+        mode_table_name (string) - output dimension table name
+    """
+    
+    print('\nStart of load_dim_travel_modes')
+    
+    #load data into pandas dataframe
+    df_travel_modes = pd.read_csv(os.path.join(input_data, mode_data_source), sep="=", header=None, names = ['code', 'name'])
+    
+    #clear data in pandas dataframe
+    df_travel_modes['code'].apply(pd.to_numeric)
+    df_travel_modes['name'] = df_travel_modes['name'].str.replace("'","").str.strip()
+    
+    #convert pandas dataframe to spark dataframe
+    df_spark_travel_modes = spark.createDataFrame(df_travel_modes)
+    
+    #write data to the dimension table
+    write_table(spark, df_spark_travel_modes, mode_table_name, file_count=1)
+
+    print('End of load_dim_travel_modes')
+    
+
+def load_dim_us_visas(spark, visas_data_source, visas_table_name):
+    """
+    This function:
+        Create and load dimension table for US visas
+    Paramters:
+        spark (object) - Spark session
+        visas_data_source (string) - path to the data source containing US visas
+        visas_table_name (string) - output dimension table name
+    """
+    
+    print('\nStart of load_dim_us_visas')
+    
+    #load data into pandas dataframe
+    df_us_visas = pd.read_csv(os.path.join(input_data, visas_data_source), sep="=", header=None, names = ['code', 'name'])
+    
+    #clear data in pandas dataframe
+    df_us_visas['code'].apply(pd.to_numeric)
+    df_us_visas['name'].str.strip()
+    
+    #convert pandas dataframe to spark dataframe
+    df_spark_us_visas = spark.createDataFrame(df_us_visas)
+    
+    #write data to the dimension table
+    write_table(spark, df_spark_us_visas, visas_table_name, file_count=1)
+    
+    print('End of load_dim_us_visas')
+    
+    
+@lru_cache(maxsize=None)
+def get_us_ports(port_data_source, state_data_source):
+    """
+    This function:
+        Parse US ports and join them with US states, parsed data are shared by all callers during the run
+    Paramters:
+        port_data_source (string) - path to the data source containing US ports
+        state_data_source (string) - path to the data source containing US states
+    Returns:
+        pandas dataframe with columns code, city, state and state_name, must not be modified by callers
+    """
+    
+    #load US ports data into pandas dataframe
+    df_us_ports = pd.read_csv(os.path.join(input_data, port_data_source), sep="=", header=None, names = ['code', 'city'])
+    
+    #clear US ports data
+    df_us_ports['code'] = df_us_ports['code'].str.replace("'","").str.replace("\t","").str.strip()
+    df_us_ports['city'] = df_us_ports['city'].str.replace("'","").str.replace("\t","").replace(to_replace=['No PORT Code.*', 'Collapsed.*'], value = 'Other US ports', regex = True).str.strip()
+    
+    #split port/city name column to obtain city name and state code
+    us_ports_split_col = df_us_ports['city'].str.split(",", n=1, expand=True)
+    
+    #update values in column city
+    df_us_ports['city'] = us_ports_split_col[0].str.strip()
+    
+    #add and format new column for state 
+    df_us_ports['state'] = us_ports_split_col[1]
+    df_us_ports['state'] = df_us_ports['state'].str.strip()
+    
+    
+    #load US states data into pandas dataframe
+    df_us_states = pd.read_csv(os.path.join(input_data, state_data_source), sep="=", header=None, names = ['state_code', 'state_name'])
+    
+    #clear US states data
+    df_us_states['state_code'] = df_us_states['state_code'].str.replace("'","").str.replace("\t","").str.strip()
+    df_us_states['state_name'] = df_us_states['state_name'].str.replace("'","").str.replace("\t","").str.strip()
+    
+    #join US ports and US states data, ports without valid US state (including 'No PORT Code' and 'Collapsed' ports) are removed
+    return df_us_ports.join(df_us_states.set_index('state_code'), on='state', how='inner', lsuffix='p', rsuffix='s')
+
+
+def get_us_ports_reference(spark, port_data_source, state_data_source):
+    """
+    This function:
+        Get Spark dataframe with codes of valid US ports, used to filter I94 immigration data
+    Paramters:
+        spark (object) - Spark session
+        port_data_source (string) - path to the data source containing US ports
+        state_data_source (string) - path to the data source containing US states
+    Returns:
+        dataframe with column code
+    """
+    
+    return spark.createDataFrame(get_us_ports(port_data_source, state_data_source)[['code']])
+
+
+def load_dim_us_ports(spark, port_data_source, state_data_source, port_table_name):
+    """
+    This function:
+        Create and load dimension table for US ports
+    Paramters:
+        spark (object) - Spark session
+        port_data_source (string) - path to the data source containing US ports
+        state_data_source (string) - path to the data source containing US states
+        port_table_name (string) - output dimension table name
+    """
+    
+    print('\nStart of load_dim_us_ports')
+    
+    #get parsed US ports shared with staging of I94 immigration data
+    df_us_ports = get_us_ports(port_data_source, state_data_source)
+        
+    #convert pandas dataframe to spark dataframe and add integer surrogate keys of ports and cities
+    df_spark_us_ports = spark.createDataFrame(df_us_ports)
+    df_spark_us_ports = df_spark_us_ports.withColumn('port_key', get_port_key(df_spark_us_ports.code)) \
+                                         .withColumn('city_key', get_city_key(df_spark_us_ports.state_name, df_spark_us_ports.city))
+    
+    #hash keys must not collide, different ports and cities must have different keys
+    key_counts = df_spark_us_ports.agg(countDistinct('code').alias('ports'), countDistinct('port_key').alias('port_keys'), \
+                                       countDistinct('state_name', 'city').alias('cities'), countDistinct('city_key').alias('city_keys')).first()
+    if key_counts.ports != key_counts.port_keys or key_counts.cities != key_counts.city_keys:
+        raise ValueError('Surrogate keys of US ports collide: {}'.format(key_counts.asDict()))
+    
+    #write data to the dimension table
+    write_table(spark, df_spark_us_ports, port_table_name, file_count=1)
+    
+    print('End of load_dim_us_ports')
+    
+
+def get_date_from_sas(column_name):
+    """
+    This function:
+        Convert SAS date (number of days since 1960-01-01) to date, evaluated natively in JVM
+    Paramters:
+        column_name (string) - name of the column containing SAS date
+    Returns:
+        column of date type, null if SAS date is null or zero
+    """
+    
+    return when(expr(column_name) != 0, expr("date_add(to_date('1960-01-01'), cast({} as int))".format(column_name)))
+
+
+def get_date(year_column, month_column, day_column):
+    """
+    This function:
+        Get date from date parts, evaluated natively in JVM
+    Paramters:
+        year_column (column) - column containing year
+        month_column (column) - column containing month
+        day_column (column) - column containing day
+    Returns:
+        column of date type, null if date parts do not form a valid date
+    """
+    
+    return to_date(concat_ws('-', year_column, month_column, day_column))
+
+
+def get_stay(depdate_column, arrdate_column):
+    """
+    This function:
+        Get visitor's stay in days from SAS departure and arrival dates
+    Paramters:
+        depdate_column (column) - column containing SAS departure date
+        arrdate_column (column) - column containing SAS arrival date
+    Returns:
+        column of integer type
+    """
+    
+    return (depdate_column - arrdate_column).cast('int')
+
+
+def get_port_key(code_column):
+    """
+    This function:
+        Get integer surrogate key of US port, 32-bit hash of port code, so the key does not depend on load order
+    Paramters:
+        code_column (column) - column containing port code
+    Returns:
+        column of integer type
+    """
+    
+    return hash_(code_column)
+
+
+def get_city_key(state_name_column, city_column):
+    """
+    This function:
+        Get integer surrogate key of US city, 32-bit hash of state name and city name in upper case,
+        the same key is computed for ports and for city temperatures
+    Paramters:
+        state_name_column (column) - column containing state name
+        city_column (column) - column containing city name
+    Returns:
+        column of integer type
+    """
+    
+    return hash_(upper(state_name_column), upper(city_column))
+
+
+def get_date_key(date_column):
+    """
+    This function:
+        Get integer surrogate key of date in yyyymmdd format
+    Paramters:
+        date_column (column) - column of date type
+    Returns:
+        column of integer type
+    """
     
-    print('End of load_dim_countries')
+    return date_format(date_column, 'yyyyMMdd').cast('int')
 
 
-def load_dim_travel_modes(spark, mode_data_source, mode_table_name):
+def get_hot_keys(df, key_columns, sample_fraction=None, hot_key_share=None):
     """
     This function:
-        Create and load dimension table for travel modes
+        Find hot join keys from key frequencies in a sample of dataframe
     Paramters:
-        spark (object) - Spark session
-        mode_data_source (string) - path to the data source containing travel modes
-        mode_table_name (string) - output dimension table name
+        df (dataframe) - dataframe to sample
+        key_columns (list) - key columns
+        sample_fraction (float) - sampled fraction of rows, defaults to SKEW_SAMPLE_FRACTION from configuration
+        hot_key_share (float) - minimum share of sampled rows of hot key, defaults to SKEW_HOT_KEY_SHARE from configuration
+    Returns:
+        list of hot keys as tuples of key values, most frequent first
     """
     
-    print('\nStart of load_dim_travel_modes')
-    
-    #load data into pandas dataframe
-    df_travel_modes = pd.read_csv(os.path.join(input_data, mode_data_source), sep="=", header=None, names = ['code', 'name'])
+    sample_fraction = sample_fraction or skew_sample_fraction
+    hot_key_share = hot_key_share or skew_hot_key_share
     
-    #clear data in pandas dataframe
-    df_travel_modes['code'].apply(pd.to_numeric)
-    df_travel_modes['name'] = df_travel_modes['name'].str.replace("'","").str.strip()
+    key_counts = df.select(*key_columns).sample(False, sample_fraction, 42).groupBy(*key_columns).count().collect()
+    sample_count = sum(row['count'] for row in key_counts)
     
-    #convert pandas dataframe to spark dataframe
-    df_spark_travel_modes = spark.createDataFrame(df_travel_modes)
+    hot_keys = sorted([row for row in key_counts if row['count'] >= sample_count * hot_key_share], key=lambda row: -row['count'])
     
-    #write data to the dimension table
-    df_spark_travel_modes.write.mode('overwrite').parquet(os.path.join(output_data, mode_table_name))
+    return [tuple(row[column] for column in key_columns) for row in hot_keys]
 
-    print('End of load_dim_travel_modes')
-    
 
-def load_dim_us_visas(spark, visas_data_source, visas_table_name):
+def join_skewed(spark, df_left, df_right, key_columns):
     """
     This function:
-        Create and load dimension table for US visas
+        Inner join large dataframe with skewed key distribution, rows of hot keys are joined with broadcast right side rows 
+        of these keys, so they are not shuffled into a few straggler partitions, remaining rows are joined as usual
     Paramters:
         spark (object) - Spark session
-        visas_data_source (string) - path to the data source containing US visas
-        visas_table_name (string) - output dimension table name
+        df_left (dataframe) - large dataframe with skewed keys
+        df_right (dataframe) - dataframe to join, rows of hot keys must fit into broadcast
+        key_columns (list) - join key columns
+    Returns:
+        joined dataframe
     """
     
-    print('\nStart of load_dim_us_visas')
-    
-    #load data into pandas dataframe
-    df_us_visas = pd.read_csv(os.path.join(input_data, visas_data_source), sep="=", header=None, names = ['code', 'name'])
-    
-    #clear data in pandas dataframe
-    df_us_visas['code'].apply(pd.to_numeric)
-    df_us_visas['name'].str.strip()
+    if not skew_join_enabled:
+        return df_left.join(df_right, key_columns, how='inner')
     
-    #convert pandas dataframe to spark dataframe
-    df_spark_us_visas = spark.createDataFrame(df_us_visas)
+    hot_keys = get_hot_keys(df_left, key_columns)
+    if not hot_keys:
+        return df_left.join(df_right, key_columns, how='inner')
     
-    #write data to the dimension table
-    df_spark_us_visas.write.mode('overwrite').parquet(os.path.join(output_data, visas_table_name))
+    print('Joining {} hot keys separately: {}'.format(len(hot_keys), hot_keys[:10]))
     
-    print('End of load_dim_us_visas')
+    df_hot_keys = broadcast(spark.createDataFrame(hot_keys, df_left.select(*key_columns).schema))
     
+    df_hot = df_left.join(df_hot_keys, key_columns, how='left_semi') \
+                    .join(broadcast(df_right.join(df_hot_keys, key_columns, how='left_semi')), key_columns, how='inner')
+    df_cold = df_left.join(df_hot_keys, key_columns, how='left_anti') \
+                     .join(df_right, key_columns, how='inner')
     
-def load_dim_us_ports(spark, port_data_source, state_data_source, port_table_name):
+    return df_hot.unionByName(df_cold)
+
+
+def get_fact_write_options():
     """
     This function:
-        Create and load dimension table for US ports
-    Paramters:
-        spark (object) - Spark session
-        port_data_source (string) - path to the data source containing US ports
-        state_data_source (string) - path to the data source containing US states
-        port_table_name (string) - output dimension table name
+        Get writer options of fact table, shared by the pipeline and compaction so both write the same layout
+    Returns:
+        dictionary of writer options
     """
     
-    print('\nStart of load_dim_us_ports')
-    
-    #load US ports data into pandas dataframe
-    df_us_ports = pd.read_csv(os.path.join(input_data, port_data_source), sep="=", header=None, names = ['code', 'city'])
-    
-    #clear US ports data
-    df_us_ports['code'] = df_us_ports['code'].str.replace("'","").str.replace("\t","").str.strip()
-    df_us_ports['city'] = df_us_ports['city'].str.replace("'","").str.replace("\t","").replace(to_replace=['No PORT Code.*', 'Collapsed.*'], value = 'Other US ports', regex = True).str.strip()
-    
-    #split port/city name column to obtain city name and state code
-    us_ports_split_col = df_us_ports['city'].str.split(",", n=1, expand=True)
-    
-    #update values in column city
-    df_us_ports['city'] = us_ports_split_col[0].str.strip()
-    
-    #add and format new column for state 
-    df_us_ports['state'] = us_ports_split_col[1]
-    df_us_ports['state'] = df_us_ports['state'].str.strip()
-    
-    
-    #load US states data into pandas dataframe
-    df_us_states = pd.read_csv(os.path.join(input_data, 'map/I94-us_states.txt'), sep="=", header=None, names = ['state_code', 'state_name'])
-    
-    #clear US states data
-    df_us_states['state_code'] = df_us_states['state_code'].str.replace("'","").str.replace("\t","").str.strip()
-    df_us_states['state_name'] = df_us_states['state_name'].str.replace("'","").str.replace("\t","").str.strip()
-    
-    #join US ports and US states data
-    df_us_ports = df_us_ports.join(df_us_states.set_index('state_code'), on='state', how='inner', lsuffix='p', rsuffix='s')
-        
-    #convert pandas dataframe to spark dataframe
-    df_spark_us_ports = spark.createDataFrame(df_us_ports)
-    
-    #write data to the dimension table
-    df_spark_us_ports.write.mode('overwrite').parquet(os.path.join(output_data, port_table_name))
-    
-    print('End of load_dim_us_ports')
-    
+    return {'parquet.block.size': fact_row_group_size_mb * 1024 * 1024}
 
-def build_fact_i94_visits(spark, stage_i94_table_name, stage_temperature_table_name, dim_ports_table_name, visits_fact_table):
+
+def build_fact_i94_visits(spark, stage_i94_table_name, stage_temperature_table_name, dim_ports_table_name, visits_fact_table, source_partitions=None):
     """
     This function:
         Create and load fact table for I94 visits
@@ -248,8 +1460,8 @@ def build_fact_i94_visits(spark, stage_i94_table_name, stage_temperature_table_n
         stage_temperature_table_name (string) - stage table containing city temperature data
         dim_ports_table_name (string) - dimension table containing US ports data
         visits_fact_table (string) - output fact table
-    Returns:
-        dataframe to be used from load_dim_date function as a parameter
+        source_partitions (dict) - SAS arrdate partitions by data source, if set only these partitions of stage table are rebuilt
+                                   and recorded in the manifest (incremental load)
     """
     
     print('\nStart of build_fact_i94_visits')
@@ -257,71 +1469,81 @@ def build_fact_i94_visits(spark, stage_i94_table_name, stage_temperature_table_n
     #load stage immigration data
     df_fact_I94_visits = spark.read.parquet(os.path.join(output_data, stage_i94_table_name))
     
-    #load stage city temperature data
-    df_dim_temperatures = spark.read.parquet(os.path.join(output_data, stage_temperature_table_name))
+    #restrict stage data to affected partitions, filter on partition column prunes the other partitions
+    if source_partitions is not None:
+        arrdate_partitions = sorted(set(int(float(partition)) for partitions in source_partitions.values() for partition in partitions))
+        df_fact_I94_visits = df_fact_I94_visits.filter(df_fact_I94_visits.arrdate.isin(arrdate_partitions))
     
-    #load dimension US port data
-    df_dim_us_ports = spark.read.parquet(os.path.join(output_data, dim_ports_table_name))
+    #load stage city temperature data keyed by date and city
+    df_dim_temperatures = spark.read.parquet(os.path.join(output_data, stage_temperature_table_name)) \
+                               .select('date_key', 'city_key', 'avgtemperature')
     
-    #create udf to convert SAS date type to ISO date type
-    get_date_from_sas = udf(lambda x: (datetime(1960, 1, 1).date() + timedelta(x)).isoformat() if x else None)
-
-    #create udf to get date from date parts
-    get_date = udf(lambda x, y, z: (datetime(x, y, z).date()).isoformat())
-
-    #create udf to get visitor's stay
-    get_stay = udf(lambda x, y: int(x - y))
+    #load surrogate keys of US ports
+    df_dim_us_ports = spark.read.parquet(os.path.join(output_data, dim_ports_table_name)).select('code', 'port_key', 'city_key')
     
-    #prepare df_fact_I94_visits table
+    #prepare df_fact_I94_visits table, stay is computed before arrdate is converted from SAS date
     df_fact_I94_visits = df_fact_I94_visits.withColumn('stay', get_stay(df_fact_I94_visits.depdate, df_fact_I94_visits.arrdate)) \
-                                            .withColumn('arrdate', get_date_from_sas(df_fact_I94_visits.arrdate)) \
-                                            .withColumn('depdate', get_date_from_sas(df_fact_I94_visits.depdate))
-    
-    #prepare df_dim_temperatures temperature table
-    df_dim_temperatures = df_dim_temperatures.withColumn('date', get_date(df_dim_temperatures.year, df_dim_temperatures.month, df_dim_temperatures.day))
+                                            .withColumn('arrdate', get_date_from_sas('arrdate')) \
+                                            .withColumn('depdate', get_date_from_sas('depdate'))
+    df_fact_I94_visits = df_fact_I94_visits.withColumn('date_key', get_date_key(df_fact_I94_visits.arrdate))
 
-    #join df_fact_I94_visits dataframe with df_dim_us_ports dataframe
-    df_fact_I94_visits = df_fact_I94_visits.join(df_dim_us_ports, df_fact_I94_visits.i94port == df_dim_us_ports.code, how='inner').drop(df_dim_us_ports.code)
+    #replace port code with port and city keys, port dimension is small so it is broadcast
+    df_fact_I94_visits = df_fact_I94_visits.join(broadcast(df_dim_us_ports), df_fact_I94_visits.i94port == df_dim_us_ports.code, how='inner') \
+                                            .drop(df_dim_us_ports.code)
+    
+    #prepared visits are read by hot key sampling and by both join branches of hot and other keys, so they are computed only once
+    df_visits_prepared = store_intermediate(df_fact_I94_visits) if skew_join_enabled else df_fact_I94_visits
     
-    #join df_fact_I94_visits dataframe with df_dim_temperatures dataframe
-    df_fact_I94_visits = df_fact_I94_visits.join(df_dim_temperatures, [df_fact_I94_visits.arrdate == df_dim_temperatures.date, \
-                                                                       df_fact_I94_visits.city == df_dim_temperatures.city, \
-                                                                       df_fact_I94_visits.state_name == df_dim_temperatures.state] , how='inner') \
-                                            .drop(df_dim_temperatures.city)
+    #join df_fact_I94_visits dataframe with df_dim_temperatures dataframe on two integer keys, hot keys are joined separately
+    df_fact_I94_visits = join_skewed(spark, df_visits_prepared, df_dim_temperatures, ['date_key', 'city_key'])
     
     #select necessary columns and write fact table partitioned by arrival date
-    df_fact_I94_visits = df_fact_I94_visits.select('cicid', 'arrdate', 'depdate', 'stay', 'i94port', 'i94cit', 'i94mode', 'i94visa', 'visatype', 'avgtemperature')
+    df_fact_I94_visits = df_fact_I94_visits.select('cicid', 'arrdate', 'date_key', 'depdate', 'stay', 'port_key', 'i94cit', 'i94mode', 'i94visa', 
+                                                   'visatype', 'avgtemperature')
     
-    #write data to the fact table
-    df_fact_I94_visits.write.mode('overwrite').partitionBy('arrdate').parquet(os.path.join(output_data, visits_fact_table))
+    #write data to the fact table clustered by port, smaller row groups let port filters skip more data
+    #on incremental load only rebuilt partitions are replaced, full load replaces whole fact table
+    write_table(spark, df_fact_I94_visits, visits_fact_table, 'arrdate', 
+                options=dict(get_fact_write_options(), partitionOverwriteMode='dynamic' if source_partitions is not None else 'static'),
+                sort_columns=fact_sort_columns, bucket_count=fact_bucket_count)
+    
+    release_intermediate(df_visits_prepared)
     
     print('End of build_fact_i94_visits')
     
-    #return dataframe to be used from load_dim_date function as a parameter
-    return df_fact_I94_visits.select('arrdate').dropDuplicates()
+    #on incremental load record rebuilt partitions, converted from SAS date without running another job on fact data
+    if source_partitions is not None:
+        for data_source, partitions in source_partitions.items():
+            write_manifest(spark, visits_fact_table, data_source, [convert_sas_date(partition).isoformat() for partition in partitions])
     
     
-def load_dim_date(spark, df_date, date_table_name):
+def load_dim_date(spark, fact_table_name, date_table_name):
     """
     This function:
-        Create and load dimension table for US visas
+        Create and load dimension table for dates
     Paramters:
         spark (object) - Spark session
-        df_date (dataframe) - dataframe containing dates        
+        fact_table_name (string) - fact table partitioned by arrival date, dates are taken from its partition listing
         date_table_name (string) - output dimension table
     """
     
     print('\nStart of load_dim_date')
     
+    #get dates from already written fact table partitions instead of recomputing the fact table
+    dates = get_partition_values(spark, fact_table_name, 'arrdate')
+    df_date = spark.createDataFrame([(date,) for date in dates], 'arrdate string')
+    df_date = df_date.withColumn('arrdate', to_date(df_date.arrdate))
+    
     #prepare date dataframe
-    df_date = df_date.withColumn('day', dayofmonth(df_date.arrdate)) \
+    df_date = df_date.withColumn('date_key', get_date_key(df_date.arrdate)) \
+                 .withColumn('day', dayofmonth(df_date.arrdate)) \
                  .withColumn('weekday', date_format(df_date.arrdate, 'E')) \
                  .withColumn('week', weekofyear(df_date.arrdate)) \
                  .withColumn('month', month(df_date.arrdate)) \
                  .withColumn('year', year(df_date.arrdate))
     
     #write data to the dimension table
-    df_date.write.mode('overwrite').parquet(os.path.join(output_data, date_table_name))    
+    write_table(spark, df_date, date_table_name, file_count=1)
     
     print('End of load_dim_date')
     
@@ -329,7 +1551,7 @@ def load_dim_date(spark, df_date, date_table_name):
 def check_column_exists(spark, table_name, column_name):
     """
     This function:
-        Check if column exists in table
+        Check if column exists in table, using schema cache instead of reading the table
     Paramters:
         spark (object) - Spark session
         table_name (dataframe) - table name to check
@@ -338,8 +1560,7 @@ def check_column_exists(spark, table_name, column_name):
     
     print('\nCheck if exists column named "{}" in table "{}"'.format(column_name, table_name))
     
-    df = spark.read.parquet(os.path.join(output_data, table_name)).limit(1)
-    if column_name in df.columns:
+    if column_name in get_table_schema(spark, table_name):
         print('Column "{}" does exists in table "{}"'.format(column_name, table_name))
     else:
         raise ValueError('Column "{}" DOES NOT exists in table "{}"'.format(column_name, table_name))
@@ -348,7 +1569,7 @@ def check_column_exists(spark, table_name, column_name):
 def check_column_type(spark, table_name, column_name, expected_type):
     """
     This function:
-        Check if column has a certain data type in table
+        Check if column has a certain data type in table, using schema cache instead of reading the table
     Paramters:
         spark (object) - Spark session
         table_name (dataframe) - table name to check
@@ -358,26 +1579,46 @@ def check_column_type(spark, table_name, column_name, expected_type):
     
     print('\nCheck if exists column {} with data type "{}" in table"{}"'.format(column_name, expected_type, table_name))
     
-    df = spark.read.parquet(os.path.join(output_data, table_name)).limit(1)
+    schema = get_table_schema(spark, table_name)
     
-    column_exists = False
-    for name, dtype in df.dtypes:
-        if name == column_name:
-            column_exists = True
-            if dtype == expected_type:
-                print('Column "{}.{}" has expected data type'.format(table_name, column_name)) 
-                return
-            else:
-                raise ValueError('Column "{}.{}" DOES NOT HAVE expected data type'.format(column_name, table_name))
-
-    if not column_exists: 
+    if column_name not in schema: 
         raise ValueError('Column "{}" DOES NOT exists in table "{}"'.format(column_name, table_name))
+    elif schema[column_name] != expected_type:
+        raise ValueError('Column "{}.{}" DOES NOT HAVE expected data type'.format(table_name, column_name))
+    else:
+        print('Column "{}.{}" has expected data type'.format(table_name, column_name)) 
+        
+
+def check_table_schemas(spark, expected_schemas=EXPECTED_SCHEMAS):
+    """
+    This function:
+        Check that all expected columns exist with expected data types in all tables, using schema cache only
+    Paramters:
+        spark (object) - Spark session
+        expected_schemas (dict) - expected column data types by column name, by table name
+    """
+    
+    print('\nCheck schemas of {} tables'.format(len(expected_schemas)))
+    
+    errors = []
+    for table_name, expected_schema in expected_schemas.items():
+        schema = get_table_schema(spark, table_name)
+        for column_name, expected_type in expected_schema.items():
+            if column_name not in schema:
+                errors.append('Column "{}" DOES NOT exists in table "{}"'.format(column_name, table_name))
+            elif schema[column_name] != expected_type:
+                errors.append('Column "{}.{}" has data type "{}", expected "{}"'.format(table_name, column_name, schema[column_name], expected_type))
+    
+    if errors:
+        raise ValueError('Schema check has failed:\n' + '\n'.join(errors))
+    else:
+        print('All table schemas have expected columns and data types')
         
 
 def check_unique_key(spark, table_name, column_list):
     """
     This function:
-        Check if column has a certain data type in table
+        Check if columns form a unique key in table
     Paramters:
         spark (object) - Spark session
         table_name (dataframe) - table name to check
@@ -386,35 +1627,35 @@ def check_unique_key(spark, table_name, column_list):
     
     print('\nCheck if unique key on table "{}"'.format(table_name))
     
-    df = spark.read.parquet(os.path.join(output_data, table_name))
+    report = run_quality_checks(spark, os.path.join(output_data, table_name), [{'rule': 'unique_key', 'columns': column_list}], table_name)
     
-    rec_count = df.count()
-    
-    if df.count() > df.dropDuplicates(column_list).count():
-        raise ValueError('Error checking unique key on table. Key has duplicates for {}'.format(table_name, column_list))
+    if not report[0]['passed']:
+        raise ValueError('Error checking unique key on table {}. Key has duplicates for {}'.format(table_name, column_list))
     else:
         print("Succesfull unique key check on table {}.".format(table_name))
         
 
 
-def run_unit_test_on_I94_arrival_date(spark, fact_table_name):
+def run_unit_test_on_I94_arrival_date(spark, fact_table_name, first_month='2016-04', last_month='2016-04'):
     """
     This function:
         Run unit test to check arrival dates in fact table
     Paramters:
         spark (object) - Spark session
-        table_name (dataframe) - table name to check
-        column_list (list) - list of columns to compare
+        fact_table_name (string) - fact table name to check
+        first_month (string) - first expected month in yyyy-mm format
+        last_month (string) - last expected month in yyyy-mm format
     """
         
     print('\nRunning unit test on table "{}"'.format(fact_table_name))
     
-    df = spark.read.parquet(os.path.join(output_data, fact_table_name))
+    first_date, last_date = get_date_window(first_month, last_month)
     
-    rec_count = df.filter((year(df.arrdate) != 2016) | (month(df.arrdate) != 4)).count()
+    report = run_quality_checks(spark, os.path.join(output_data, fact_table_name), \
+                                [{'rule': 'date_window', 'column': 'arrdate', 'start': first_date, 'end': last_date}], fact_table_name)
                           
-    if rec_count == 0:
-        print("Unit test has passed. Fact table contains only records for April 2016.")
+    if report[0]['passed']:
+        print("Unit test has passed. Fact table contains only records from {} to {}.".format(first_date, last_date))
     else:
         raise ValueError("Unit test has failed. Fact table contains records outside expected period.")
         
@@ -431,9 +1672,9 @@ def check_row_count(spark, table_name):
     
     print('\nCheck row count on table "{}"'.format(table_name))
     
-    df = spark.read.parquet(os.path.join(output_data, table_name))
+    report = run_quality_checks(spark, os.path.join(output_data, table_name), [{'rule': 'row_count', 'min': 1}], table_name)
     
-    rec_count = df.count()
+    rec_count = report[0]['details']['row_count']
     
     if rec_count == 0:
         raise ValueError('Quality check for table "{}" has failed. The table has no records.'.format(table_name))
@@ -441,150 +1682,461 @@ def check_row_count(spark, table_name):
         print("Succesfull quality check on table {}. The table has {} records.".format(table_name, rec_count))
         
 
+def run_table_quality_checks(spark, table_rules):
+    """
+    This function:
+        Run declarative quality checks, each table is scanned only once for all its rules
+    Paramters:
+        spark (object) - Spark session
+        table_rules (dict) - quality rules by table name, see quality module for rule format
+    Returns:
+        quality report, list of rule results with table, rule, passed and details
+    """
+    
+    report = []
+    for table_name, rules in table_rules.items():
+        report.extend(run_quality_checks(spark, os.path.join(output_data, table_name), rules, table_name))
+    
+    raise_on_failure(report)
+    
+    print('\nAll {} quality checks have passed'.format(len(report)))
+    
+    return report
+
 
-def get_top_10_warmest_states(spark, fact_visit_table, dim_port_table):
+def build_agg_state_city_arrivals(spark, fact_visit_table, dim_port_table, agg_table):
     """
     This function:
-        Get average temperature in top 10 states ordered by number od arrivals descending
+        Create and load aggregate table of arrivals and temperatures by state, city and arrival date
     Paramters:
         spark (object) - Spark session
         fact_visit_table (string) - fact table containing visits
         dim_port_table (string) - dimension table containing US ports
+        agg_table (string) - output aggregate table
     """
     
-    print('\nGet average temperature in top 10 states ordered by number od arrivals descending\n')
+    print('\nStart of build_agg_state_city_arrivals')
     
     #load necessary data
-    df_read_visits = spark.read.parquet(os.path.join(output_data, fact_visit_table))
+    df_read_visits = read_table(spark, fact_visit_table)
     df_read_ports = spark.read.parquet(os.path.join(output_data, dim_port_table))
     
-    #join dataframe by port code
-    df_query = df_read_visits.join(df_read_ports, df_read_visits.i94port == df_read_ports.code, how='inner').drop(df_read_ports.code)
+    #aggregate visits joined with ports, temperature is kept as sum and count so averages can be rolled up exactly
+    df_agg = aggregate_state_city_arrivals(df_read_visits, df_read_ports, ['state', 'state_name', 'city', 'arrdate'])
     
-    #get top 10 desc
-    df_query.groupBy('state_name').agg(round(avg('avgtemperature'), 2).alias('avg_temperature'), count('*').alias('count')).orderBy(desc('count')).show(10)   
+    #write data to the aggregate table
+    write_table(spark, df_agg, agg_table, file_count=1)
+    
+    print('End of build_agg_state_city_arrivals')
+    
+    
+def aggregate_state_city_arrivals(df_visits, df_ports, group_columns):
+    """
+    This function:
+        Join visits with ports and aggregate arrivals and temperatures
+    Paramters:
+        df_visits (dataframe) - visits from fact table
+        df_ports (dataframe) - US ports from dimension table
+        group_columns (list) - columns to group by
+    Returns:
+        dataframe with group columns, arrivals, temperature_sum and temperature_count
+    """
+    
+    df_query = df_visits.join(df_ports, 'port_key', how='inner')
+    
+    return df_query.groupBy(*group_columns).agg(count('*').alias('arrivals'), \
+                                                sum_('avgtemperature').alias('temperature_sum'), \
+                                                count('avgtemperature').alias('temperature_count'))
     
 
-def get_number_of_arrivals_in_top_5_warmest_states(spark, fact_visit_table, dim_port_table):
+def get_state_city_arrivals(spark, fact_visit_table, dim_port_table, agg_table, state_code=None):
     """
     This function:
-        Get number of arrival in top 5 warmest states
+        Get arrivals and temperatures by state and city, from aggregate table or from fact table if aggregate table does not exist
     Paramters:
         spark (object) - Spark session
         fact_visit_table (string) - fact table containing visits
         dim_port_table (string) - dimension table containing US ports
+        agg_table (string) - aggregate table built by build_agg_state_city_arrivals
+        state_code (string) - if set, fact table is read only for ports of the state, other states may be missing in the result
+    Returns:
+        dataframe with state, state_name, city, arrivals, temperature_sum and temperature_count
     """
     
-    print('\nGet number of arrival in top 5 warmest states\n')
+    try:
+        return spark.read.parquet(os.path.join(output_data, agg_table))
+    except AnalysisException:
+        print('Aggregate table "{}" not found, querying fact table'.format(agg_table))
     
     #load necessary data
-    df_read_visits = spark.read.parquet(os.path.join(output_data, fact_visit_table))
+    df_read_visits = read_table(spark, fact_visit_table)
     df_read_ports = spark.read.parquet(os.path.join(output_data, dim_port_table))
     
-    #join dataframe by port code
-    df_query = df_read_visits.join(df_read_ports, df_read_visits.i94port == df_read_ports.code, how='inner').drop(df_read_ports.code)
-    
-    #get top 5 desc
-    df_query.groupBy('state_name').agg(round(avg('avgtemperature'), 2).alias('avg_temperature'), count('*').alias('count')).orderBy(desc('avg_temperature')).show(5)     
+    #filter on port keys of the state is pushed down to parquet, row groups of fact sorted by port without these ports are skipped
+    if state_code is not None:
+        df_read_ports = df_read_ports.filter(df_read_ports.state == state_code)
+        port_keys = [row.port_key for row in df_read_ports.select('port_key').collect()]
+        df_read_visits = df_read_visits.filter(df_read_visits.port_key.isin(port_keys))
     
+    return aggregate_state_city_arrivals(df_read_visits, df_read_ports, ['state', 'state_name', 'city'])
+
+
+def summarize_arrivals(df_arrivals, group_column):
+    """
+    This function:
+        Roll up arrivals and average temperature from aggregated arrivals
+    Paramters:
+        df_arrivals (dataframe) - dataframe returned by get_state_city_arrivals
+        group_column (string) - column to group by
+    Returns:
+        dataframe with group column, avg_temperature and count
+    """
     
-def get_top_10_warmest_cities(spark, fact_visit_table, dim_port_table, state_code):
+    return df_arrivals.groupBy(group_column).agg(round_(sum_('temperature_sum') / sum_('temperature_count'), 2).alias('avg_temperature'), \
+                                                 sum_('arrivals').alias('count'))
+
+
+def build_fact_sketches(spark, fact_visit_table, dim_port_table):
     """
     This function:
-        Get top 10 warmest cities in state with number of arrivals
+        Create and load sketch side tables of fact table used by approximate queries, see sketches module
     Paramters:
         spark (object) - Spark session
         fact_visit_table (string) - fact table containing visits
         dim_port_table (string) - dimension table containing US ports
-        state_code (string) - state code
     """
     
-    print('\nGet top 10 warmest cities in state with number of arrivals\n')
+    print('\nStart of build_fact_sketches')
     
     #load necessary data
-    df_read_visits = spark.read.parquet(os.path.join(output_data, fact_visit_table))
+    df_read_visits = read_table(spark, fact_visit_table)
     df_read_ports = spark.read.parquet(os.path.join(output_data, dim_port_table))
     
-    #join dataframe by port code
-    df_query = df_read_visits.join(df_read_ports, df_read_visits.i94port == df_read_ports.code, how='inner').drop(df_read_ports.code)
+    #build sketches and write them into small side tables
+    sketch_tables = build_sketches(spark, df_read_visits, df_read_ports, sketch_eps, sketch_confidence, sketch_distinct_rsd, 
+                                   sketch_quantile_accuracy, sketch_sample_fraction)
+    for sketch_table, df_sketch in sketch_tables.items():
+        write_table(spark, df_sketch, sketch_table, file_count=1)
     
-    #get top 10 desc
-    df_query.filter(df_query.state == state_code).groupBy('city').agg(round(avg('avgtemperature'), 2).alias('avg_temperature'), count('*').alias('count')).orderBy(desc('count')).show(5)
-
+    print('End of build_fact_sketches')
     
-        
-def main():
+
+def show_approximate_arrivals(spark, group_column, order_column, n, state_code=None):
     """
     This function:
-        Builds a ETL pipeline to process I94 immigration data and US city temperature data into fact and dimension tables on datalake
-    Args:
-        No args.
+        Show arrivals and average temperature by state or city estimated from sketch side tables, with error bounds
+    Paramters:
+        spark (object) - Spark session
+        group_column (string) - 'state_name' or 'city'
+        order_column (string) - column ordered by descending, 'count' or 'avg_temperature'
+        n (int) - number of shown rows
+        state_code (string) - if set, only cities of the state are shown
     """
+    
+    df_arrivals = spark.read.parquet(os.path.join(output_data, 'sketch_arrivals'))
+    df_temperatures = spark.read.parquet(os.path.join(output_data, 'sketch_temperatures'))
+    
+    df_estimates = get_approximate_arrivals(spark, df_arrivals, df_temperatures, group_column, state_code)
+    
+    print(df_estimates.sort_values(order_column, ascending=False).head(n).to_string(index=False))
+    
 
-    #create spark session
-    spark = create_spark_session()
+def get_top_10_warmest_states(spark, fact_visit_table, dim_port_table, agg_table='agg_state_city_arrivals', approximate=False):
+    """
+    This function:
+        Get average temperature in top 10 states ordered by number od arrivals descending
+    Paramters:
+        spark (object) - Spark session
+        fact_visit_table (string) - fact table containing visits
+        dim_port_table (string) - dimension table containing US ports
+        agg_table (string) - aggregate table of arrivals by state and city
+        approximate (boolean) - answer from sketch side tables with error bounds instead of aggregate or fact table
+    """
+    
+    print('\nGet average temperature in top 10 states ordered by number od arrivals descending\n')
+    
+    if approximate:
+        show_approximate_arrivals(spark, 'state_name', 'count', 10)
+        return
     
+    #load arrivals by state and city
+    df_arrivals = get_state_city_arrivals(spark, fact_visit_table, dim_port_table, agg_table)
     
-    #load I94 immigration data into Spark session, clean them and write them into stage tables
-    stage_i94_immigration_data(spark, '../../data/18-83510-I94-Data-2016/i94_apr16_sub.sas7bdat', 'stage_i94_immigration')
+    #get top 10 desc
+    summarize_arrivals(df_arrivals, 'state_name').orderBy(desc('count')).show(10)   
     
-    #load US city temperature data into Spark session, clean them and write them into stage tables
-    stage_city_temperature_data(spark, 'city_temperature.csv', 'stage_city_temperatures')
 
+def get_number_of_arrivals_in_top_5_warmest_states(spark, fact_visit_table, dim_port_table, agg_table='agg_state_city_arrivals', approximate=False):
+    """
+    This function:
+        Get number of arrival in top 5 warmest states
+    Paramters:
+        spark (object) - Spark session
+        fact_visit_table (string) - fact table containing visits
+        dim_port_table (string) - dimension table containing US ports
+        agg_table (string) - aggregate table of arrivals by state and city
+        approximate (boolean) - answer from sketch side tables with error bounds instead of aggregate or fact table
+    """
+    
+    print('\nGet number of arrival in top 5 warmest states\n')
+    
+    if approximate:
+        show_approximate_arrivals(spark, 'state_name', 'avg_temperature', 5)
+        return
+    
+    #load arrivals by state and city
+    df_arrivals = get_state_city_arrivals(spark, fact_visit_table, dim_port_table, agg_table)
+    
+    #get top 5 desc
+    summarize_arrivals(df_arrivals, 'state_name').orderBy(desc('avg_temperature')).show(5)     
     
-    #create and load dimension table for countries
-    load_dim_countries(spark, 'map/I94-country-codes.txt', 'dim_countries')
     
-    #create and write dimension table for travel modes
-    load_dim_travel_modes(spark, 'map/I94-travel_modes.txt', 'dim_travel_modes')
+def get_top_10_warmest_cities(spark, fact_visit_table, dim_port_table, state_code, agg_table='agg_state_city_arrivals', approximate=False):
+    """
+    This function:
+        Get top 10 warmest cities in state with number of arrivals
+    Paramters:
+        spark (object) - Spark session
+        fact_visit_table (string) - fact table containing visits
+        dim_port_table (string) - dimension table containing US ports
+        state_code (string) - state code
+        agg_table (string) - aggregate table of arrivals by state and city
+        approximate (boolean) - answer from sketch side tables with error bounds instead of aggregate or fact table
+    """
     
-    #create and write dimension table for US visas
-    load_dim_us_visas(spark, 'map/I94-us_visas.txt', 'dim_us_visas')
+    print('\nGet top 10 warmest cities in state with number of arrivals\n')
     
-    #create and write dimension table for US ports
-    load_dim_us_ports(spark, 'map/I94-us_ports.txt', 'map/I94-us_states.txt', 'dim_us_ports')
+    if approximate:
+        show_approximate_arrivals(spark, 'city', 'count', 5, state_code)
+        return
     
+    #load arrivals by state and city
+    df_arrivals = get_state_city_arrivals(spark, fact_visit_table, dim_port_table, agg_table, state_code)
     
-    #create and write fact table for I94 immigration data and US city temperature data
-    df_visits = build_fact_i94_visits(spark, 'stage_i94_immigration', 'stage_city_temperatures', 'dim_us_ports', 'fact_i94_visits')
+    #get top 10 desc
+    summarize_arrivals(df_arrivals.filter(df_arrivals.state == state_code), 'city').orderBy(desc('count')).show(5)
+
     
+        
+def build_fact_for_sources(spark, data_sources, incremental, stage_i94_table_name, stage_temperature_table_name, dim_ports_table_name, visits_fact_table):
+    """
+    This function:
+        Create and load fact table for I94 visits from staged data sources
+    Paramters:
+        spark (object) - Spark session
+        data_sources (list) - I94 immigration data sources loaded by the run
+        incremental (boolean) - if True, only partitions of data sources recorded in stage manifest and not yet recorded 
+                                in fact manifest are rebuilt
+        stage_i94_table_name (string) - stage table containing I94 immigration data
+        stage_temperature_table_name (string) - stage table containing city temperature data
+        dim_ports_table_name (string) - dimension table containing US ports data
+        visits_fact_table (string) - output fact table
+    """
     
-    #create and write dimension table for US visas
-    load_dim_date(spark, df_visits, 'dim_date')
+    source_partitions = None
+    if incremental:
+        #sources already built into fact table are skipped, so only partitions of newly staged sources are rebuilt
+        built_sources = set(row.source_file for row in read_manifest(spark, visits_fact_table))
+        source_partitions = {data_source: get_manifest_partitions(spark, stage_i94_table_name, data_source) 
+                             for data_source in data_sources if data_source not in built_sources}
+        if not source_partitions:
+            print('\nAll sources already built into fact table "{}", skipping'.format(visits_fact_table))
+            return
     
+    build_fact_i94_visits(spark, stage_i94_table_name, stage_temperature_table_name, dim_ports_table_name, visits_fact_table, source_partitions)
     
-    #quality checks - start
+
+def run_pipeline_quality_checks(spark, first_month, last_month, check_date_window):
+    """
+    This function:
+        Run schema checks and data quality checks on tables produced by the pipeline
+    Paramters:
+        spark (object) - Spark session
+        first_month (string) - first loaded month in yyyy-mm format
+        last_month (string) - last loaded month in yyyy-mm format
+        check_date_window (boolean) - check that fact table contains only arrivals of loaded months,
+                                      not used on incremental load where fact table keeps previously loaded months
+    """
     
-    #check if exists column named 'cicid' in table named 'fact_i94_visits'
-    check_column_exists(spark, 'fact_i94_visits', 'cicid')
+    #check if all tables have expected columns with expected data types, schemas are read from schema cache
+    check_table_schemas(spark)
+    
+    #run unique key, arrival date and row count checks, one scan per table
+    fact_rules = [
+        {'rule': 'row_count', 'min': 1},
+        {'rule': 'unique_key', 'columns': ['cicid']},
+        {'rule': 'not_null', 'column': 'port_key'}
+    ]
+    if check_date_window:
+        first_date, last_date = get_date_window(first_month, last_month)
+        fact_rules.append({'rule': 'date_window', 'column': 'arrdate', 'start': first_date, 'end': last_date})
+    
+    run_table_quality_checks(spark, {
+        'fact_i94_visits': fact_rules,
+        'dim_us_ports': [
+            {'rule': 'row_count', 'min': 1}
+        ]
+    })
     
-    #check if exists column named 'cicid' with data type {double} in table named 'fact_i94_visits'
-    check_column_type(spark, 'fact_i94_visits', 'cicid', 'double')
+
+def run_instrumented_stage(spark, stage):
+    """
+    This function:
+        Run pipeline stage in its own FAIR scheduler pool and record its metrics in the run report
+    Paramters:
+        spark (object) - Spark session
+        stage (object) - pipeline stage
+    Returns:
+        stage result
+    """
     
-    #run quality check by checking the unique key
-    check_unique_key(spark, 'fact_i94_visits', ['cicid'])
+    spark.sparkContext.setLocalProperty('spark.scheduler.pool', stage.name)
     
-    #run unit test to check arrival dates in fact table
-    run_unit_test_on_I94_arrival_date(spark, 'fact_i94_visits')
+    with instrument(spark, stage.name, [os.path.join(output_data, table_name) for table_name in stage.outputs], collect_stage_metrics):
+        return stage.function(*stage.args)
+
+
+def get_pipeline_stages(spark, i94_data_sources, incremental):
+    """
+    This function:
+        Declare pipeline stages with their inputs and outputs
+    Paramters:
+        spark (object) - Spark session
+        i94_data_sources (list) - I94 immigration data sources loaded by the run
+        incremental (boolean) - incremental load
+    Returns:
+        list of pipeline stages
+    """
     
-    #run quality check by checking the row count
-    check_row_count(spark, 'dim_us_ports')
+    def source(path):
+        return 'file:' + os.path.join(input_data, path)
     
-    #quality checks - end
+    return [
+        #load I94 immigration data into Spark session, clean them and write them into stage tables, months are staged concurrently
+        Stage('stage_i94_immigration', stage_i94_months, (spark, i94_data_sources, 'stage_i94_immigration', incremental), 
+              ['file:' + data_source for data_source in i94_data_sources] + [source('map/I94-us_ports.txt'), source('map/I94-us_states.txt')], 
+              ['stage_i94_immigration']),
+        
+        #load US city temperature data into Spark session, clean them and write them into stage tables
+        Stage('stage_city_temperatures', stage_city_temperature_data, (spark, 'city_temperature.csv', 'stage_city_temperatures', start_month, end_month), 
+              [source('city_temperature.csv'), source('map/I94-us_ports.txt'), source('map/I94-us_states.txt')], ['stage_city_temperatures']),
+        
+        #create and load dimension tables for countries, travel modes, US visas and US ports
+        Stage('dim_countries', load_dim_countries, (spark, 'map/I94-country-codes.txt', 'dim_countries'), 
+              [source('map/I94-country-codes.txt')], ['dim_countries']),
+        Stage('dim_travel_modes', load_dim_travel_modes, (spark, 'map/I94-travel_modes.txt', 'dim_travel_modes'), 
+              [source('map/I94-travel_modes.txt')], ['dim_travel_modes']),
+        Stage('dim_us_visas', load_dim_us_visas, (spark, 'map/I94-us_visas.txt', 'dim_us_visas'), 
+              [source('map/I94-us_visas.txt')], ['dim_us_visas']),
+        Stage('dim_us_ports', load_dim_us_ports, (spark, 'map/I94-us_ports.txt', 'map/I94-us_states.txt', 'dim_us_ports'), 
+              [source('map/I94-us_ports.txt'), source('map/I94-us_states.txt')], ['dim_us_ports']),
+        
+        #create and write fact table for I94 immigration data and US city temperature data
+        Stage('fact_i94_visits', build_fact_for_sources, 
+              (spark, i94_data_sources, incremental, 'stage_i94_immigration', 'stage_city_temperatures', 'dim_us_ports', 'fact_i94_visits'), 
+              ['stage_i94_immigration', 'stage_city_temperatures', 'dim_us_ports'], ['fact_i94_visits']),
+        
+        #create and write dimension table for dates and aggregate table used by sample queries
+        Stage('dim_date', load_dim_date, (spark, 'fact_i94_visits', 'dim_date'), ['fact_i94_visits'], ['dim_date']),
+        Stage('agg_state_city_arrivals', build_agg_state_city_arrivals, (spark, 'fact_i94_visits', 'dim_us_ports', 'agg_state_city_arrivals'), 
+              ['fact_i94_visits', 'dim_us_ports'], ['agg_state_city_arrivals']),
+        
+        #quality checks
+        Stage('quality_checks', run_pipeline_quality_checks, (spark, start_month, end_month, not incremental), 
+              list(EXPECTED_SCHEMAS.keys()), [])
+    ] + ([
+        #create and write sketch side tables used by approximate sample queries
+        Stage('fact_sketches', build_fact_sketches, (spark, 'fact_i94_visits', 'dim_us_ports'), ['fact_i94_visits', 'dim_us_ports'], 
+              ['sketch_arrivals', 'sketch_port_visitors', 'sketch_stay_quantiles', 'sketch_temperatures'])
+    ] if build_sketches_enabled else [])
     
+
+def run_sample_queries(spark, approximate=None):
+    """
+    This function:
+        Run instrumented sample queries on tables produced by the pipeline
+    Paramters:
+        spark (object) - Spark session
+        approximate (boolean) - answer queries from sketch side tables, defaults to QUERY_MODE 'approximate' in configuration
+    """
     
-    #sample queries - run 
+    approximate = query_mode == 'approximate' if approximate is None else approximate
     
     #get average temperature in top 10 states ordered by number od arrivals descending
-    get_top_10_warmest_states(spark, 'fact_i94_visits', 'dim_us_ports')
+    with instrument(spark, 'query:get_top_10_warmest_states', collect_stage_metrics=collect_stage_metrics):
+        get_top_10_warmest_states(spark, 'fact_i94_visits', 'dim_us_ports', approximate=approximate)
     
     #get number of arrival in top 5 warmest states
-    get_number_of_arrivals_in_top_5_warmest_states(spark, 'fact_i94_visits', 'dim_us_ports')
+    with instrument(spark, 'query:get_number_of_arrivals_in_top_5_warmest_states', collect_stage_metrics=collect_stage_metrics):
+        get_number_of_arrivals_in_top_5_warmest_states(spark, 'fact_i94_visits', 'dim_us_ports', approximate=approximate)
     
     #get top 10 warmest cities in State of California with number of arrivals
-    get_top_10_warmest_cities(spark, 'fact_i94_visits', 'dim_us_ports', 'CA')
+    with instrument(spark, 'query:get_top_10_warmest_cities', collect_stage_metrics=collect_stage_metrics):
+        get_top_10_warmest_cities(spark, 'fact_i94_visits', 'dim_us_ports', 'CA', approximate=approximate)
+
+
+def main():
+    """
+    This function:
+        Builds a ETL pipeline to process I94 immigration data and US city temperature data into fact and dimension tables on datalake
+    Args:
+        'queries' to run only sample queries on already built tables with 'query' Spark profile, optional command line argument
+    """
+
+    #create spark session
+    queries_only = len(sys.argv) > 1 and sys.argv[1] == 'queries'
+    spark = create_spark_session('query' if queries_only else None)
+    run_started_at = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    
+    if queries_only:
+        run_sample_queries(spark)
+        write_text_file(spark, os.path.join(output_data, run_report_folder, 'queries_{}.json'.format(run_started_at)), get_run_report_json())
+        spark.stop()
+        return
+    
+    #overwrite only partitions present in written data, so months staged concurrently do not replace each other
+    incremental = load_mode == 'incremental'
+    spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+    
+    #checkpointed intermediate dataframes are written into checkpoint directory
+    if checkpoint_dir:
+        spark.sparkContext.setCheckpointDir(checkpoint_dir)
+    
+    #find monthly I94 immigration data files for loaded period
+    i94_data_sources = discover_i94_data_sources(spark, start_month, end_month)
+    if not i94_data_sources:
+        raise ValueError('No I94 immigration data found for months from {} to {}'.format(start_month, end_month))
+    
+    
+    #incremental load appends to existing tables, so their schemas are checked from schema cache before any expensive stage runs
+    if incremental:
+        check_table_schemas(spark, {table_name: expected_schema for table_name, expected_schema in EXPECTED_SCHEMAS.items() 
+                                    if get_table_fingerprint(spark, table_name) is not None})
+    
+    #run pipeline stages, independent stages run concurrently and stages with unchanged inputs and code are skipped
+    state_path = os.path.join(output_data, pipeline_state_file)
+    state_json = read_text_file(spark, state_path)
+    state = json.loads(state_json) if state_json else {}
+    
+    try:
+        run_pipeline(get_pipeline_stages(spark, i94_data_sources, incremental), 
+                     lambda input_name: get_input_fingerprint(spark, input_name), 
+                     lambda table_name: get_table_fingerprint(spark, table_name) is not None, 
+                     state, get_concurrency(max_concurrent_stages), 
+                     lambda stage: run_instrumented_stage(spark, stage))
+    finally:
+        #record successful stages, also when pipeline has failed, so they are skipped on the next run
+        write_text_file(spark, state_path, json.dumps(state, indent=2, sort_keys=True))
+        
+        #write run report with metrics of all instrumented stages and queries
+        write_text_file(spark, os.path.join(output_data, run_report_folder, 'run_{}.json'.format(run_started_at)), get_run_report_json())
+    
+    
+    #sample queries
+    run_sample_queries(spark)
     
-    #sample queries - end
+    #write run report including sample queries
+    write_text_file(spark, os.path.join(output_data, run_report_folder, 'run_{}.json'.format(run_started_at)), get_run_report_json())
     
     #end spark session
     spark.stop()
@@ -0,0 +1,218 @@
+import calendar
+import os
+import re
+import sys
+from datetime import date
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import array, col, element_at, floor, lit, pow as pow_, rand, when, initcap, concat_ws, expr
+
+import etl
+
+
+#rates of missing values observed in April 2016 I94 immigration data
+DEPDATE_NULL_RATE = 0.046
+I94MODE_NULL_RATE = 0.000077
+MATFLAG_NULL_RATE = 0.0447
+
+#share of rows delivered twice
+DUPLICATE_RATE = 0.01
+
+#port popularity skew, port index is drawn as floor(n * u ** PORT_SKEW), higher values concentrate arrivals on fewer ports
+PORT_SKEW = 4
+
+VISA_TYPES = ['B1', 'B2', 'WT', 'WB', 'F1', 'F2', 'E2', 'CP', 'GMT', 'I', 'M1']
+
+
+def get_port_codes(port_data_source='map/I94-us_ports.txt'):
+    """
+    This function:
+        Get all port codes from port mapping file, including invalid and non US ports
+    Paramters:
+        port_data_source (string) - path to the data source containing ports
+    Returns:
+        list of port codes, busiest ports first
+    """
+
+    port_re_filter = re.compile(r'\'(.*)\'.*\'(.*)\'')
+
+    with open(os.path.join(etl.input_data, port_data_source)) as file:
+        port_codes = [port_re_filter.search(line)[1] for line in file if port_re_filter.search(line)]
+
+    #put real hot ports first, so skewed distribution sends most arrivals there, and add codes missing from mapping file
+    hot_ports = ['NYC', 'MIA', 'LOS', 'SFR', 'HHW', 'NEW', 'CHI', 'ORL', 'HOU', 'FTL']
+
+    return hot_ports + [code for code in port_codes if code not in hot_ports] + ['XXX', 'ZZZ', '999']
+
+
+def get_country_codes(country_data_source='map/I94-country-codes.txt'):
+    """
+    This function:
+        Get country codes from country mapping file
+    Paramters:
+        country_data_source (string) - path to the data source containing countries
+    Returns:
+        list of country codes as floats, as stored in I94 immigration data
+    """
+
+    with open(os.path.join(etl.input_data, country_data_source)) as file:
+        return [float(line.split('=')[0]) for line in file if line.strip()]
+
+
+def pick(values, seed):
+    """
+    This function:
+        Get column picking uniformly random value from list
+    Paramters:
+        values (list) - values to pick from
+        seed (int) - random seed
+    Returns:
+        column
+    """
+
+    return element_at(array(*[lit(value) for value in values]), (floor(rand(seed) * len(values)) + 1).cast('int'))
+
+
+def generate_i94_month(spark, data_year, data_month, row_count, output_path, seed=0):
+    """
+    This function:
+        Generate synthetic I94 immigration data for one month and write them as parquet
+    Paramters:
+        spark (object) - Spark session
+        data_year (int) - arrival year
+        data_month (int) - arrival month
+        row_count (int) - number of unique records, duplicates are added on top
+        output_path (string) - output folder
+        seed (int) - random seed
+    """
+
+    port_codes = get_port_codes()
+    country_codes = get_country_codes()
+
+    days_in_month = calendar.monthrange(data_year, data_month)[1]
+    first_arrdate = (date(data_year, data_month, 1) - date(1960, 1, 1)).days
+    cicid_offset = (data_year * 12 + data_month) * 100000000
+
+    df_i94 = spark.range(row_count) \
+                  .select((col('id') + cicid_offset).cast('double').alias('cicid'),
+                          lit(float(data_year)).alias('i94yr'),
+                          lit(float(data_month)).alias('i94mon'),
+                          pick(country_codes, seed + 1).alias('i94cit'),
+                          pick(country_codes, seed + 2).alias('i94res'),
+                          element_at(array(*[lit(code) for code in port_codes]),
+                                     (floor(pow_(rand(seed + 3), PORT_SKEW) * len(port_codes)) + 1).cast('int')).alias('i94port'),
+                          (floor(rand(seed + 4) * days_in_month) + first_arrdate).cast('double').alias('arrdate'),
+                          when(rand(seed + 5) < I94MODE_NULL_RATE, None).otherwise(pick([1.0, 1.0, 1.0, 2.0, 3.0, 9.0], seed + 6)).alias('i94mode'),
+                          pick(['CA', 'NY', 'FL', 'TX', 'HI', 'IL', 'NJ', 'WA'], seed + 7).alias('i94addr'),
+                          floor(rand(seed + 8) * 60).alias('stay_days'),
+                          (floor(rand(seed + 9) * 80) + 1).cast('double').alias('i94bir'),
+                          pick([1.0, 2.0, 2.0, 2.0, 3.0], seed + 10).alias('i94visa'),
+                          lit(1.0).alias('count'),
+                          pick(['F', 'M'], seed + 11).alias('gender'),
+                          pick(['AA', 'UA', 'DL', 'BA', 'LH', 'AF', 'VS'], seed + 12).alias('airline'),
+                          pick(VISA_TYPES, seed + 13).alias('visatype'),
+                          rand(seed + 14).alias('depdate_draw'),
+                          rand(seed + 15).alias('matflag_draw'))
+
+    df_i94 = df_i94.withColumn('depdate', when(df_i94.depdate_draw < DEPDATE_NULL_RATE, None).otherwise(df_i94.arrdate + df_i94.stay_days)) \
+                   .withColumn('matflag', when((df_i94.matflag_draw < MATFLAG_NULL_RATE) | (df_i94.depdate_draw < DEPDATE_NULL_RATE), None).otherwise(lit('M'))) \
+                   .withColumn('biryear', (data_year - df_i94.i94bir)) \
+                   .drop('stay_days', 'depdate_draw', 'matflag_draw')
+
+    #add re-delivered duplicate rows
+    df_i94 = df_i94.union(df_i94.sample(False, DUPLICATE_RATE, seed + 16))
+
+    df_i94.write.mode('overwrite').parquet(output_path)
+
+
+def generate_city_temperatures(spark, first_month, last_month, world_scale, output_path, seed=0):
+    """
+    This function:
+        Generate synthetic daily city temperatures for US port cities and worldwide cities and write them as csv with header
+    Paramters:
+        spark (object) - Spark session
+        first_month (string) - first month in yyyy-mm format
+        last_month (string) - last month in yyyy-mm format
+        world_scale (int) - number of non US city rows per US city row
+        output_path (string) - output csv file path
+        seed (int) - random seed
+    """
+
+    #US cities of valid ports, state names as in temperature data
+    df_us_ports = etl.get_us_ports('map/I94-us_ports.txt', 'map/I94-us_states.txt')
+    us_cities = sorted(set(zip(df_us_ports['city'], df_us_ports['state_name'])))
+
+    days = [(data_year, data_month, day) for data_year, data_month in etl.get_months(first_month, last_month) \
+                                           for day in range(1, calendar.monthrange(data_year, data_month)[1] + 1)]
+
+    df_us = spark.createDataFrame([('North America', 'US', state, city) for city, state in us_cities], 'region string, country string, state string, city string')
+    df_days = spark.createDataFrame(days, 'year int, month int, day int')
+
+    df_world = spark.range(len(us_cities) * world_scale) \
+                    .select(pick(['Europe', 'Asia', 'Africa', 'South/Central America & Carribean'], seed + 1).alias('region'),
+                            concat_ws('', lit('C'), (col('id') % 200).cast('string')).alias('country'),
+                            lit(None).cast('string').alias('state'),
+                            concat_ws('', lit('CITY'), col('id').cast('string')).alias('city'))
+
+    df_temperatures = df_us.union(df_world).crossJoin(df_days) \
+                           .withColumn('avgtemperature', expr('round(30 + 60 * rand({}), 1)'.format(seed + 2)))
+
+    #keep source column naming and order of city_temperature.csv
+    df_temperatures.select(col('region').alias('Region'), col('country').alias('Country'), initcap(col('state')).alias('State'),
+                           initcap(col('city')).alias('City'), col('month').alias('Month'), col('day').alias('Day'),
+                           col('year').alias('Year'), col('avgtemperature').alias('AvgTemperature')) \
+                   .coalesce(1).write.mode('overwrite').option('header', 'True').csv(output_path)
+
+
+def generate_dataset(spark, output_folder, first_month, last_month, rows_per_month, world_scale=10, seed=0):
+    """
+    This function:
+        Generate synthetic I94 immigration data for every month in range and matching city temperature data
+    Paramters:
+        spark (object) - Spark session
+        output_folder (string) - output folder, I94 months are written into it as i94_<mon><yy>_sub.parquet
+                                 and temperatures as city_temperature.csv
+        first_month (string) - first month in yyyy-mm format
+        last_month (string) - last month in yyyy-mm format
+        rows_per_month (int) - number of unique I94 records per month
+        world_scale (int) - number of non US city temperature rows per US city row
+        seed (int) - random seed
+    Returns:
+        list of generated I94 data source paths
+    """
+
+    print('\nStart of generate_dataset, {} I94 rows per month'.format(rows_per_month))
+
+    data_sources = []
+    for index, (data_year, data_month) in enumerate(etl.get_months(first_month, last_month)):
+        data_source = os.path.join(output_folder, 'i94_{}{}_sub.parquet'.format(calendar.month_abbr[data_month].lower(), str(data_year)[-2:]))
+        generate_i94_month(spark, data_year, data_month, rows_per_month, data_source, seed + index * 100)
+        data_sources.append(data_source)
+
+    generate_city_temperatures(spark, first_month, last_month, world_scale, os.path.join(output_folder, 'city_temperature.csv'), seed)
+
+    print('End of generate_dataset')
+
+    return data_sources
+
+
+def main():
+    """
+    This function:
+        Generate synthetic dataset on local Spark session
+    Args:
+        output folder, number of I94 rows per month, first month and last month, all optional command line arguments
+    """
+
+    output_folder = sys.argv[1] if len(sys.argv) > 1 else 'synthetic_input'
+    rows_per_month = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    first_month = sys.argv[3] if len(sys.argv) > 3 else '2016-04'
+    last_month = sys.argv[4] if len(sys.argv) > 4 else first_month
+
+    spark = SparkSession.builder.master('local[*]').appName('nd-de-generate-data').getOrCreate()
+
+    generate_dataset(spark, output_folder, first_month, last_month, rows_per_month)
+
+    spark.stop()
+
+if __name__ == "__main__":
+    main()
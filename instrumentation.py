@@ -0,0 +1,211 @@
+"""
+Per-stage performance instrumentation.
+
+Every instrumented block runs its Spark jobs in its own job group. When the block ends, its job and stage IDs are
+taken from the status tracker, executor-side stage metrics are optionally collected from the Spark monitoring
+REST API, together with quantiles of records per task that show how balanced tasks were, and output tables are
+summarized from file system metadata. Records are kept in a run report that can be written as JSON.
+"""
+
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.request import urlopen
+
+
+#stage metrics summed over all Spark stages of instrumented block
+STAGE_METRICS = ['inputBytes', 'inputRecords', 'outputBytes', 'outputRecords', 'shuffleReadBytes', 'shuffleReadRecords',
+                 'shuffleWriteBytes', 'shuffleWriteRecords', 'memoryBytesSpilled', 'diskBytesSpilled', 'executorRunTime']
+
+#quantiles of records per task reported for every Spark stage
+TASK_QUANTILES = [0.0, 0.25, 0.5, 0.75, 1.0]
+
+run_report = {'started_at': datetime.utcnow().isoformat(), 'stages': []}
+report_lock = threading.Lock()
+
+
+def get_stage_metrics(spark, stage_ids):
+    """
+    This function:
+        Collect executor-side metrics of Spark stages from the Spark monitoring REST API
+    Paramters:
+        spark (object) - Spark session
+        stage_ids (list) - Spark stage IDs
+    Returns:
+        dictionary of metric values summed over all stages and stage attempts, empty if Spark UI is disabled
+    """
+
+    spark_context = spark.sparkContext
+    if not spark_context.uiWebUrl:
+        return {}
+
+    metrics = dict.fromkeys(STAGE_METRICS, 0)
+
+    for stage_id in stage_ids:
+        url = '{}/api/v1/applications/{}/stages/{}'.format(spark_context.uiWebUrl, spark_context.applicationId, stage_id)
+        try:
+            with urlopen(url, timeout=10) as response:
+                attempts = json.loads(response.read().decode('utf-8'))
+        except Exception:
+            #stage data may be already evicted from the UI, e.g. spark.ui.retainedStages exceeded
+            continue
+
+        for attempt in attempts:
+            for metric in STAGE_METRICS:
+                metrics[metric] += attempt.get(metric, 0) or 0
+
+    return metrics
+
+
+def get_task_balance(spark, stage_ids):
+    """
+    This function:
+        Collect distribution of records processed by tasks of Spark stages from the Spark monitoring REST API,
+        it shows how balanced task partitions were, e.g. straggler tasks of skewed joins
+    Paramters:
+        spark (object) - Spark session
+        stage_ids (list) - Spark stage IDs
+    Returns:
+        dictionary of task record quantiles by stage ID, empty if Spark UI is disabled
+    """
+
+    spark_context = spark.sparkContext
+    if not spark_context.uiWebUrl:
+        return {}
+
+    base_url = '{}/api/v1/applications/{}/stages'.format(spark_context.uiWebUrl, spark_context.applicationId)
+
+    balance = {}
+    for stage_id in stage_ids:
+        try:
+            with urlopen('{}/{}'.format(base_url, stage_id), timeout=10) as response:
+                attempts = json.loads(response.read().decode('utf-8'))
+            attempt = attempts[-1]
+            with urlopen('{}/{}/{}/taskSummary?quantiles={}'.format(base_url, stage_id, attempt['attemptId'], ','.join(map(str, TASK_QUANTILES))), 
+                         timeout=10) as response:
+                summary = json.loads(response.read().decode('utf-8'))
+        except Exception:
+            continue
+
+        #tasks read records either from input files or from shuffle
+        records = [input_records + shuffle_records for input_records, shuffle_records in \
+                   zip(summary.get('inputMetrics', {}).get('recordsRead', [0] * len(TASK_QUANTILES)), 
+                       summary.get('shuffleReadMetrics', {}).get('readRecords', [0] * len(TASK_QUANTILES)))]
+
+        balance[stage_id] = {'tasks': attempt.get('numTasks'),
+                             'records_quantiles': dict(zip(map(str, TASK_QUANTILES), records)),
+                             'max_to_median': round(records[-1] / records[len(records) // 2], 2) if records[len(records) // 2] else None}
+
+    return balance
+
+
+def get_output_summary(spark, path):
+    """
+    This function:
+        Summarize written output from file system metadata
+    Paramters:
+        spark (object) - Spark session
+        path (string) - output table path
+    Returns:
+        dictionary with number of data files and total bytes, None if output does not exist
+    """
+
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    file_system = jvm_path.getFileSystem(spark._jsc.hadoopConfiguration())
+
+    if not file_system.exists(jvm_path):
+        return None
+
+    file_count = 0
+    byte_count = 0
+    files = file_system.listFiles(jvm_path, True)
+    while files.hasNext():
+        status = files.next()
+        name = status.getPath().getName()
+        if not name.startswith('_') and not name.startswith('.'):
+            file_count += 1
+            byte_count += status.getLen()
+
+    return {'files': file_count, 'bytes': byte_count}
+
+
+@contextmanager
+def instrument(spark, name, output_paths=(), collect_stage_metrics=True):
+    """
+    This function:
+        Instrument block of pipeline code, its record is added to the run report when block ends
+    Paramters:
+        spark (object) - Spark session
+        name (string) - name of instrumented pipeline stage or query
+        output_paths (list) - paths of tables written by the block
+        collect_stage_metrics (boolean) - collect executor-side metrics from the Spark monitoring REST API
+    Returns:
+        record of the block, context manager yields it so the block can add own values
+    """
+
+    spark_context = spark.sparkContext
+    job_group = '{}-{}'.format(name, uuid.uuid4().hex[:8])
+    previous_job_group = spark_context.getLocalProperty('spark.jobGroup.id')
+    spark_context.setJobGroup(job_group, name)
+
+    record = {'name': name, 'started_at': datetime.utcnow().isoformat(), 'status': 'running'}
+    start = time.perf_counter()
+
+    try:
+        yield record
+        record['status'] = 'succeeded'
+    except Exception as error:
+        record['status'] = 'failed'
+        record['error'] = repr(error)
+        raise
+    finally:
+        record['wall_seconds'] = round(time.perf_counter() - start, 3)
+
+        status_tracker = spark_context.statusTracker()
+        job_ids = sorted(status_tracker.getJobIdsForGroup(job_group))
+        job_infos = [status_tracker.getJobInfo(job_id) for job_id in job_ids]
+        stage_ids = sorted(set(stage_id for job_info in job_infos if job_info for stage_id in job_info.stageIds))
+
+        record['job_ids'] = job_ids
+        record['stage_ids'] = stage_ids
+        record['metrics'] = get_stage_metrics(spark, stage_ids) if collect_stage_metrics else {}
+        record['task_balance'] = get_task_balance(spark, stage_ids) if collect_stage_metrics else {}
+        record['outputs'] = {path: get_output_summary(spark, path) for path in output_paths}
+
+        spark_context.setLocalProperty('spark.jobGroup.id', previous_job_group)
+
+        with report_lock:
+            run_report['stages'].append(record)
+
+        print('"{}" {} in {:.1f} s'.format(name, record['status'], record['wall_seconds']))
+
+
+def record_session_startup(profile, seconds, reused):
+    """
+    This function:
+        Add Spark session startup to the run report
+    Paramters:
+        profile (string) - Spark profile of the session
+        seconds (float) - time to get the session
+        reused (boolean) - running session was reused
+    """
+
+    with report_lock:
+        run_report.setdefault('sessions', []).append({'profile': profile, 'reused': reused, 'startup_seconds': round(seconds, 3),
+                                                      'started_at': datetime.utcnow().isoformat()})
+
+
+def get_run_report_json():
+    """
+    This function:
+        Get run report as JSON
+    Returns:
+        JSON string with run start time, end time and records of all instrumented blocks
+    """
+
+    with report_lock:
+        report = dict(run_report, finished_at=datetime.utcnow().isoformat())
+        return json.dumps(report, indent=2, default=str)
@@ -0,0 +1,201 @@
+import hashlib
+import inspect
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+
+#types of stage arguments and module globals included in code fingerprint
+PLAIN_TYPES = (str, int, float, bool, list, tuple, dict, type(None))
+
+class Stage:
+    """
+    Pipeline stage with explicit inputs and outputs.
+
+    Stage depends on every stage producing any of its inputs, independent stages can run concurrently.
+    """
+
+    def __init__(self, name, function, args=(), inputs=(), outputs=()):
+        """
+        Paramters:
+            name (string) - unique stage name
+            function (function) - function running the stage
+            args (tuple) - arguments of the function
+            inputs (list) - names of stage inputs, e.g. source files and tables read by the stage
+            outputs (list) - names of tables written by the stage
+        """
+
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def get_code_fingerprint(self):
+        """
+        This function:
+            Get fingerprint of stage code and its plain arguments, Spark session and other objects are ignored,
+            code includes functions called by the stage function and settings they read, see get_code_references
+        Returns:
+            hexadecimal SHA-256 digest
+        """
+
+        try:
+            sources, values = get_code_references(self.function)
+        except (OSError, TypeError):
+            sources, values = {'': getattr(self.function, '__qualname__', repr(self.function))}, {}
+
+        plain_args = [arg for arg in self.args if isinstance(arg, PLAIN_TYPES)]
+
+        fingerprint = {'sources': sources, 'globals': values, 'args': plain_args}
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_code_names(code):
+    """
+    This function:
+        Get names used by compiled code, including code of inner functions and lambdas
+    Paramters:
+        code (object) - code object
+    Returns:
+        set of names
+    """
+
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            names |= get_code_names(constant)
+
+    return names
+
+
+def get_code_references(function):
+    """
+    This function:
+        Collect source of function and of all functions from the same folder it calls directly or indirectly,
+        together with plain module globals they read, e.g. settings from configuration and declared schemas,
+        functions of other packages (PySpark, pandas) are not followed
+    Paramters:
+        function (function) - stage function
+    Returns:
+        tuple of dictionaries, function source by qualified function name and global value by qualified global name
+    """
+
+    folder = os.path.dirname(os.path.abspath(inspect.getsourcefile(function)))
+
+    sources = {}
+    values = {}
+    pending = [function]
+    while pending:
+        current = pending.pop()
+        current_name = '{}.{}'.format(current.__module__, current.__qualname__)
+        if current_name in sources:
+            continue
+
+        sources[current_name] = inspect.getsource(current)
+        values[current_name + '.__defaults__'] = [value for value in current.__defaults__ or () if isinstance(value, PLAIN_TYPES)]
+
+        for name in get_code_names(current.__code__):
+            if name not in current.__globals__:
+                continue
+            #cached functions are followed to the wrapped function
+            value = inspect.unwrap(current.__globals__[name]) if callable(current.__globals__[name]) else current.__globals__[name]
+            if inspect.isfunction(value):
+                try:
+                    source_file = inspect.getsourcefile(value)
+                except TypeError:
+                    continue
+                if source_file and os.path.dirname(os.path.abspath(source_file)) == folder:
+                    pending.append(value)
+            elif isinstance(value, PLAIN_TYPES):
+                values['{}.{}'.format(current.__module__, name)] = value
+
+    return sources, values
+
+
+def get_dependencies(stages):
+    """
+    This function:
+        Get upstream stages of each stage from stage inputs and outputs
+    Paramters:
+        stages (list) - pipeline stages
+    Returns:
+        dictionary of sets of upstream stage names by stage name
+    """
+
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError('Output "{}" is written by stages "{}" and "{}"'.format(output, producers[output], stage.name))
+            producers[output] = stage.name
+
+    return {stage.name: set(producers[name] for name in stage.inputs if name in producers) - {stage.name} for stage in stages}
+
+
+def run_pipeline(stages, get_input_fingerprint, output_exists, state, max_workers=4, stage_runner=None):
+    """
+    This function:
+        Run pipeline stages in dependency order, independent stages concurrently, skipping stages whose
+        inputs and code have not changed since their last successful run
+    Paramters:
+        stages (list) - pipeline stages
+        get_input_fingerprint (function) - returns fingerprint of input by its name, None if input does not exist
+        output_exists (function) - returns True if output with given name exists
+        state (dict) - fingerprints of last successful runs by stage name, updated in place after each successful stage
+        max_workers (int) - maximum number of concurrently running stages
+        stage_runner (function) - called with stage in the worker thread to run it, returns stage result,
+                                  defaults to calling stage function with stage arguments
+    Returns:
+        dictionary of stage results by stage name, skipped stages are not included
+    """
+
+    dependencies = get_dependencies(stages)
+    stages_by_name = {stage.name: stage for stage in stages}
+
+    #check dependency graph is acyclic before running anything
+    resolved = set()
+    while len(resolved) < len(stages):
+        ready = [name for name, upstream in dependencies.items() if name not in resolved and upstream <= resolved]
+        if not ready:
+            raise ValueError('Pipeline stages have cyclic dependencies: {}'.format(sorted(set(stages_by_name) - resolved)))
+        resolved.update(ready)
+
+    def run_stage(stage):
+        fingerprint = {'code': stage.get_code_fingerprint(), 'inputs': {name: get_input_fingerprint(name) for name in stage.inputs}}
+
+        if state.get(stage.name) == fingerprint and all(output_exists(name) for name in stage.outputs):
+            print('\nStage "{}" skipped, inputs and code have not changed'.format(stage.name))
+            return False, None
+
+        result = stage_runner(stage) if stage_runner else stage.function(*stage.args)
+        state[stage.name] = fingerprint
+
+        return True, result
+
+    results = {}
+    finished = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(finished) < len(stages):
+            for name, upstream in dependencies.items():
+                if name not in finished and name not in running.values() and upstream <= finished:
+                    running[executor.submit(run_stage, stages_by_name[name])] = name
+
+            done, _ = wait(list(running), return_when=FIRST_EXCEPTION)
+
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    #let already running stages finish, so their state is recorded, then stop the pipeline
+                    wait(list(running))
+                    raise RuntimeError('Pipeline stage "{}" has failed'.format(name)) from error
+
+                executed, result = future.result()
+                if executed:
+                    results[name] = result
+                finished.add(name)
+
+    return results
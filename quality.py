@@ -0,0 +1,146 @@
+"""
+Declarative data quality checks evaluated in one aggregated scan per table.
+
+Rules are dictionaries with key 'rule' and rule specific parameters:
+    {'rule': 'row_count', 'min': 1, 'max': None}
+    {'rule': 'unique_key', 'columns': ['cicid']}
+    {'rule': 'not_null', 'column': 'depdate'}
+    {'rule': 'value_range', 'column': 'stay', 'min': 0, 'max': 365}
+    {'rule': 'date_window', 'column': 'arrdate', 'start': '2016-04-01', 'end': '2016-04-30'}
+"""
+
+from functools import reduce
+from pyspark.sql.functions import col, count, countDistinct, lit, sum as sum_, when, min as min_, max as max_, to_date
+
+
+def get_rule_aggregations(rule, index):
+    """
+    This function:
+        Get aggregate expressions needed to evaluate rule
+    Paramters:
+        rule (dict) - quality rule
+        index (int) - position of the rule, used to give aggregate columns unique names
+    Returns:
+        list of aggregate columns
+    """
+
+    prefix = 'r{}_'.format(index)
+    rule_type = rule['rule']
+
+    if rule_type == 'row_count':
+        return []
+
+    elif rule_type == 'unique_key':
+        key_columns = [col(column) for column in rule['columns']]
+        any_null = reduce(lambda x, y: x | y, [column.isNull() for column in key_columns])
+        return [countDistinct(*key_columns).alias(prefix + 'distinct'),
+                sum_(when(any_null, 1).otherwise(0)).alias(prefix + 'nulls')]
+
+    elif rule_type == 'not_null':
+        return [sum_(when(col(rule['column']).isNull(), 1).otherwise(0)).alias(prefix + 'nulls')]
+
+    elif rule_type == 'value_range':
+        column = col(rule['column'])
+        outside = lit(False)
+        if rule.get('min') is not None:
+            outside = outside | (column < rule['min'])
+        if rule.get('max') is not None:
+            outside = outside | (column > rule['max'])
+        return [sum_(when(outside, 1).otherwise(0)).alias(prefix + 'outside'),
+                min_(column).alias(prefix + 'min'),
+                max_(column).alias(prefix + 'max')]
+
+    elif rule_type == 'date_window':
+        column = col(rule['column'])
+        outside = (column < to_date(lit(rule['start']))) | (column > to_date(lit(rule['end'])))
+        return [sum_(when(outside, 1).otherwise(0)).alias(prefix + 'outside'),
+                min_(column).alias(prefix + 'min'),
+                max_(column).alias(prefix + 'max')]
+
+    else:
+        raise ValueError('Unknown quality rule "{}"'.format(rule_type))
+
+
+def evaluate_rule(rule, index, result):
+    """
+    This function:
+        Evaluate rule from aggregated result row
+    Paramters:
+        rule (dict) - quality rule
+        index (int) - position of the rule
+        result (dict) - aggregated values of the table scan
+    Returns:
+        tuple of passed flag (boolean) and details (dict)
+    """
+
+    prefix = 'r{}_'.format(index)
+    rule_type = rule['rule']
+    row_count = result['row_count']
+
+    if rule_type == 'row_count':
+        passed = row_count >= rule.get('min', 1) and (rule.get('max') is None or row_count <= rule['max'])
+        return passed, {'row_count': row_count}
+
+    elif rule_type == 'unique_key':
+        distinct_count = result[prefix + 'distinct']
+        null_count = result[prefix + 'nulls'] or 0
+        duplicate_count = row_count - null_count - distinct_count
+        return duplicate_count == 0 and null_count == 0, {'duplicates': duplicate_count, 'null_keys': null_count}
+
+    elif rule_type == 'not_null':
+        null_count = result[prefix + 'nulls'] or 0
+        return null_count == 0, {'nulls': null_count}
+
+    else:
+        outside_count = result[prefix + 'outside'] or 0
+        details = {'outside': outside_count, 'min': result[prefix + 'min'], 'max': result[prefix + 'max']}
+        return outside_count == 0, {key: str(value) if key != 'outside' else value for key, value in details.items()}
+
+
+def run_quality_checks(spark, table_path, rules, table_name=None):
+    """
+    This function:
+        Evaluate all quality rules of table in one aggregated scan
+    Paramters:
+        spark (object) - Spark session
+        table_path (string) - path to the parquet table
+        rules (list) - list of quality rules
+        table_name (string) - table name used in the report, defaults to table path
+    Returns:
+        list of rule results, each a dict with table, rule, passed and details
+    """
+
+    table_name = table_name or table_path
+
+    print('\nRunning {} quality checks on table "{}"'.format(len(rules), table_name))
+
+    df = spark.read.parquet(table_path)
+
+    aggregations = [count(lit(1)).alias('row_count')]
+    for index, rule in enumerate(rules):
+        aggregations.extend(get_rule_aggregations(rule, index))
+
+    result = df.agg(*aggregations).collect()[0].asDict()
+
+    report = []
+    for index, rule in enumerate(rules):
+        passed, details = evaluate_rule(rule, index, result)
+        report.append({'table': table_name, 'rule': rule, 'passed': passed, 'details': details})
+        print('{} {} {}'.format('PASSED' if passed else 'FAILED', rule, details))
+
+    return report
+
+
+def raise_on_failure(report):
+    """
+    This function:
+        Raise error if any rule in quality report has failed
+    Paramters:
+        report (list) - quality report returned by run_quality_checks
+    """
+
+    failures = [result for result in report if not result['passed']]
+
+    if failures:
+        raise ValueError('Quality checks have failed: {}'.format('; '.join( \
+            '{} {} {}'.format(result['table'], result['rule'], result['details']) for result in failures)))
@@ -0,0 +1,192 @@
+import os
+import time
+from collections import OrderedDict
+from pyspark.sql.functions import desc
+
+import etl
+
+
+class QueryService:
+    """
+    Long-lived query layer over the fact and dimension tables.
+
+    Keeps one Spark session, caches dim_us_ports and arrivals by state and city in memory and
+    keeps an LRU cache of query results. Cached data are reloaded when any underlying table is written again,
+    tables are checked on explicit refresh and at most once per refresh interval when queries run.
+    """
+
+    def __init__(self, spark=None, fact_visit_table='fact_i94_visits', dim_port_table='dim_us_ports',
+                 agg_table='agg_state_city_arrivals', result_cache_size=128, refresh_seconds=None):
+        """
+        Paramters:
+            spark (object) - Spark session, running session is reused or new session with 'query' profile is created if not set
+            fact_visit_table (string) - fact table containing visits
+            dim_port_table (string) - dimension table containing US ports
+            agg_table (string) - aggregate table of arrivals by state and city
+            result_cache_size (int) - maximum number of query results kept in the result cache
+            refresh_seconds (float) - minimum time between checks of underlying tables by queries, checks list files,
+                                      which is slow on S3, defaults to QUERY_REFRESH_SECONDS from configuration
+        """
+
+        self.spark = spark or etl.create_spark_session('query')
+        self.fact_visit_table = fact_visit_table
+        self.dim_port_table = dim_port_table
+        self.agg_table = agg_table
+        self.result_cache_size = result_cache_size
+        self.refresh_seconds = etl.query_refresh_seconds if refresh_seconds is None else refresh_seconds
+
+        self.results = OrderedDict()
+        self.fingerprints = None
+        self.checked_at = None
+        self.df_ports = None
+        self.df_arrivals = None
+
+    def get_fingerprints(self):
+        """
+        This function:
+            Get fingerprints of all tables the queries depend on
+        Returns:
+            tuple of table fingerprints
+        """
+
+        return tuple(etl.get_table_fingerprint(self.spark, table_name) \
+                     for table_name in (self.fact_visit_table, self.dim_port_table, self.agg_table))
+
+    def refresh(self, force=False):
+        """
+        This function:
+            Reload cached tables and clear result cache if any underlying table has changed
+        Paramters:
+            force (boolean) - reload even if tables have not changed
+        """
+
+        fingerprints = self.get_fingerprints()
+        self.checked_at = time.monotonic()
+
+        if not force and fingerprints == self.fingerprints:
+            return
+
+        self.release()
+
+        self.df_ports = self.spark.read.parquet(os.path.join(etl.output_data, self.dim_port_table)).cache()
+        self.df_arrivals = etl.get_state_city_arrivals(self.spark, self.fact_visit_table, self.dim_port_table, self.agg_table).cache()
+        self.fingerprints = fingerprints
+
+    def refresh_if_due(self):
+        """
+        This function:
+            Refresh cached tables if they were not checked within the refresh interval
+        """
+
+        if self.checked_at is None or time.monotonic() - self.checked_at >= self.refresh_seconds:
+            self.refresh()
+
+    def release(self):
+        """
+        This function:
+            Release cached tables and clear result cache
+        """
+
+        for df in (self.df_ports, self.df_arrivals):
+            if df is not None:
+                df.unpersist()
+
+        self.df_ports = None
+        self.df_arrivals = None
+        self.results.clear()
+
+    def run_query(self, query_name, parameters, build_query):
+        """
+        This function:
+            Return query result from result cache or run the query and cache its result
+        Paramters:
+            query_name (string) - query name, part of the cache key
+            parameters (tuple) - query parameters, part of the cache key
+            build_query (function) - function returning dataframe with query result
+        Returns:
+            list of result rows as dictionaries
+        """
+
+        self.refresh_if_due()
+
+        key = (query_name, parameters)
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+
+        result = [row.asDict() for row in build_query().collect()]
+
+        self.results[key] = result
+        if len(self.results) > self.result_cache_size:
+            self.results.popitem(last=False)
+
+        return result
+
+    def get_top_states(self, n=10):
+        """
+        This function:
+            Get average temperature in top N states ordered by number of arrivals descending
+        Paramters:
+            n (int) - number of states
+        Returns:
+            list of rows with state_name, avg_temperature and count
+        """
+
+        return self.run_query('top_states', (n,), \
+                              lambda: etl.summarize_arrivals(self.df_arrivals, 'state_name').orderBy(desc('count')).limit(n))
+
+    def get_top_warmest_states(self, n=5):
+        """
+        This function:
+            Get number of arrivals in top N warmest states
+        Paramters:
+            n (int) - number of states
+        Returns:
+            list of rows with state_name, avg_temperature and count
+        """
+
+        return self.run_query('top_warmest_states', (n,), \
+                              lambda: etl.summarize_arrivals(self.df_arrivals, 'state_name').orderBy(desc('avg_temperature')).limit(n))
+
+    def get_cities_by_state(self, state_code, n=10):
+        """
+        This function:
+            Get top N cities in state ordered by number of arrivals descending, with average temperature
+        Paramters:
+            state_code (string) - state code
+            n (int) - number of cities
+        Returns:
+            list of rows with city, avg_temperature and count
+        """
+
+        return self.run_query('cities_by_state', (state_code, n), \
+                              lambda: etl.summarize_arrivals(self.df_arrivals.filter(self.df_arrivals.state == state_code), 'city') \
+                                         .orderBy(desc('count')).limit(n))
+
+    def get_top_warmest_cities(self, state_code, n=10):
+        """
+        This function:
+            Get top N warmest cities in state with number of arrivals
+        Paramters:
+            state_code (string) - state code
+            n (int) - number of cities
+        Returns:
+            list of rows with city, avg_temperature and count
+        """
+
+        return self.run_query('top_warmest_cities', (state_code, n), \
+                              lambda: etl.summarize_arrivals(self.df_arrivals.filter(self.df_arrivals.state == state_code), 'city') \
+                                         .orderBy(desc('avg_temperature')).limit(n))
+
+    def get_ports(self, state_code):
+        """
+        This function:
+            Get US ports in state
+        Paramters:
+            state_code (string) - state code
+        Returns:
+            list of rows with code and city
+        """
+
+        return self.run_query('ports', (state_code,), \
+                              lambda: self.df_ports.filter(self.df_ports.state == state_code).select('code', 'city').orderBy('code'))
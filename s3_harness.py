@@ -0,0 +1,183 @@
+import json
+import os
+import sys
+import time
+import uuid
+from pyspark.sql.functions import col, expr
+
+import etl
+
+
+def start_moto_server(port=5000):
+    """
+    This function:
+        Start moto server, a local S3 compatible stand-in, in background thread
+    Paramters:
+        port (int) - server port
+    Returns:
+        tuple of server and its endpoint URL
+    """
+
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+
+    return server, 'http://127.0.0.1:{}'.format(port)
+
+
+def get_s3_client(endpoint):
+    """
+    This function:
+        Create boto3 S3 client of the stand-in, with credentials of the pipeline
+    Paramters:
+        endpoint (string) - endpoint URL
+    Returns:
+        S3 client
+    """
+
+    import boto3
+
+    return boto3.client('s3', endpoint_url=endpoint, region_name='us-east-1',
+                        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'], aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+
+
+def get_visits(spark, row_count, days, first_id=0):
+    """
+    This function:
+        Create synthetic visits partitioned by arrival date
+    Paramters:
+        spark (object) - Spark session
+        row_count (int) - number of rows
+        days (int) - number of arrival dates
+        first_id (int) - first cicid
+    Returns:
+        dataframe with cicid, arrdate and port_key
+    """
+
+    return spark.range(first_id, first_id + row_count) \
+                .select(col('id').alias('cicid'),
+                        expr('date_add(date\'2016-04-01\', cast(id % {} as int))'.format(days)).alias('arrdate'),
+                        (col('id') % 300).cast('int').alias('port_key'))
+
+
+def get_leftovers(s3_client, bucket, prefix):
+    """
+    This function:
+        Find pending multipart uploads and magic committer folders left under prefix
+    Paramters:
+        s3_client (object) - S3 client
+        bucket (string) - bucket name
+        prefix (string) - key prefix
+    Returns:
+        tuple of pending upload count and list of keys under __magic folders
+    """
+
+    uploads = s3_client.list_multipart_uploads(Bucket=bucket, Prefix=prefix).get('Uploads', [])
+    objects = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix).get('Contents', [])
+
+    return len(uploads), [item['Key'] for item in objects if '__magic' in item['Key']]
+
+
+def run_checks(spark, s3_client, bucket, prefix, row_count=100000, days=5):
+    """
+    This function:
+        Write a partitioned table to the stand-in through etl.write_table and check S3A commit, partition replacement,
+        failed job atomicity and commit manifest
+    Paramters:
+        spark (object) - Spark session
+        s3_client (object) - S3 client
+        bucket (string) - bucket name
+        prefix (string) - key prefix of output folder
+        row_count (int) - number of rows of the table
+        days (int) - number of arrdate partitions
+    Returns:
+        list of tuples of check name, result and detail
+    """
+
+    table_name = 'harness_visits'
+    table_path = os.path.join(etl.output_data, table_name)
+    results = []
+
+    #full overwrite is committed by configured committer and listed in commit manifest
+    start = time.perf_counter()
+    etl.write_table(spark, get_visits(spark, row_count, days), table_name, 'arrdate', options={'partitionOverwriteMode': 'static'})
+    write_seconds = time.perf_counter() - start
+
+    manifest_json = etl.read_text_file(spark, os.path.join(etl.output_data, etl.commit_manifest_folder, table_name + '.json'))
+    manifest = json.loads(manifest_json) if manifest_json else None
+    results.append(('overwrite committed by S3A committer', manifest is not None and manifest['committer'] == etl.s3_committer,
+                    'committer {}'.format(manifest and manifest['committer'])))
+    results.append(('overwrite row count', spark.read.parquet(table_path).count() == row_count, '{:.1f} s'.format(write_seconds)))
+    results.append(('commit manifest lists files', bool(manifest and manifest['files']),
+                    '{} files'.format(len(manifest['files']) if manifest else 0)))
+
+    #dynamic overwrite replaces only the written partition
+    etl.write_table(spark, get_visits(spark, 10, 1, first_id=row_count), table_name, 'arrdate', options={'partitionOverwriteMode': 'dynamic'})
+    counts = {str(row.arrdate): row['count'] for row in spark.read.parquet(table_path).groupBy('arrdate').count().collect()}
+    results.append(('dynamic overwrite replaces written partition only',
+                    counts.get('2016-04-01') == 10 and sum(counts.values()) == 10 + row_count - row_count // days, str(counts)))
+
+    #failed job commits nothing
+    df_failing = get_visits(spark, 1000, days, first_id=2 * row_count).withColumn('port_key', expr('cast(assert_true(cicid < 0) as int)'))
+    try:
+        etl.write_table(spark, df_failing, table_name, 'arrdate', mode='append')
+        failed = False
+    except Exception:
+        failed = True
+    results.append(('failed append leaves table unchanged', failed and spark.read.parquet(table_path).count() == sum(counts.values()), ''))
+
+    upload_count, magic_keys = get_leftovers(s3_client, bucket, prefix)
+    results.append(('no pending uploads or magic folders left', upload_count == 0 and not magic_keys,
+                    '{} uploads, {} magic keys'.format(upload_count, len(magic_keys))))
+
+    return results
+
+
+def main():
+    """
+    This function:
+        Check S3 output path of the pipeline against a local S3 compatible stand-in, moto server is started unless
+        an endpoint of running stand-in, e.g. MinIO, is given, credentials are taken from [AWS] or environment
+    Args:
+        endpoint URL and bucket name, both optional command line arguments, tests/test_s3_output.py runs it against moto
+    """
+
+    server = None
+    if len(sys.argv) > 1:
+        endpoint = sys.argv[1]
+    else:
+        os.environ['AWS_ACCESS_KEY_ID'] = os.environ.get('AWS_ACCESS_KEY_ID') or 'testing'
+        os.environ['AWS_SECRET_ACCESS_KEY'] = os.environ.get('AWS_SECRET_ACCESS_KEY') or 'testing'
+        server, endpoint = start_moto_server()
+    bucket = sys.argv[2] if len(sys.argv) > 2 else 'nd-de-harness'
+
+    s3_client = get_s3_client(endpoint)
+    if bucket not in [item['Name'] for item in s3_client.list_buckets().get('Buckets', [])]:
+        s3_client.create_bucket(Bucket=bucket)
+
+    #pipeline writes to the stand-in, S3A settings are selected by scheme of output path
+    prefix = 'harness-{}/'.format(uuid.uuid4().hex[:8])
+    etl.output_data = 's3a://{}/{}'.format(bucket, prefix)
+    etl.s3_endpoint = endpoint
+    etl.s3_path_style_access = True
+
+    #chunked SAS reader needs no Spark package besides the S3A committer
+    etl.sas_reader = 'chunked'
+    spark = etl.create_spark_session('local-dev')
+
+    try:
+        results = run_checks(spark, s3_client, bucket, prefix)
+    finally:
+        spark.stop()
+        if server is not None:
+            server.stop()
+
+    for name, passed, detail in results:
+        print('{} {} {}'.format('PASS' if passed else 'FAIL', name, detail))
+
+    if not all(passed for _, passed, _ in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Chunked sas7bdat reader, an alternative to the spark-sas7bdat package.
+
+The SAS file is read by the pandas iterator based SAS reader in chunks of fixed number of rows. Every chunk is
+converted to an Arrow table with explicit schema and written as one row group of a parquet file, so memory use
+depends on chunk size only, not on file size. The parquet file is then read by Spark like any other staged source.
+No Maven package is needed, pyarrow is imported only when the reader is used.
+"""
+
+import os
+
+import pandas as pd
+
+
+#columns of I94 immigration data with their Arrow data types, SAS numeric values are doubles
+I94_SAS_COLUMNS = [
+    ('cicid', 'float64'), ('i94yr', 'float64'), ('i94mon', 'float64'), ('i94cit', 'float64'), ('i94res', 'float64'),
+    ('i94port', 'string'), ('arrdate', 'float64'), ('i94mode', 'float64'), ('i94addr', 'string'), ('depdate', 'float64'),
+    ('i94bir', 'float64'), ('i94visa', 'float64'), ('count', 'float64'), ('dtadfile', 'string'), ('visapost', 'string'),
+    ('occup', 'string'), ('entdepa', 'string'), ('entdepd', 'string'), ('entdepu', 'string'), ('matflag', 'string'),
+    ('biryear', 'float64'), ('dtaddto', 'string'), ('gender', 'string'), ('insnum', 'string'), ('airline', 'string'),
+    ('admnum', 'float64'), ('fltno', 'string'), ('visatype', 'string')
+]
+
+
+def get_arrow_schema(columns=I94_SAS_COLUMNS):
+    """
+    This function:
+        Get Arrow schema from column names and data types
+    Paramters:
+        columns (list) - tuples of column name and Arrow data type name
+    Returns:
+        Arrow schema
+    """
+
+    import pyarrow as pa
+
+    return pa.schema([pa.field(name, pa.type_for_alias(data_type)) for name, data_type in columns])
+
+
+def convert_sas_to_parquet(data_source, output_path, chunk_size=200000, columns=I94_SAS_COLUMNS, encoding='latin-1'):
+    """
+    This function:
+        Convert sas7bdat file to parquet file chunk by chunk, with bounded memory
+    Paramters:
+        data_source (string) - local path of sas7bdat file
+        output_path (string) - local path of written parquet file, replaced only when conversion succeeds
+        chunk_size (int) - number of rows read, converted and written at once
+        columns (list) - tuples of column name and Arrow data type name, other columns of SAS file are dropped
+        encoding (string) - encoding of SAS string values
+    Returns:
+        number of converted rows
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = get_arrow_schema(columns)
+    column_names = [name for name, _ in columns]
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    temporary_path = output_path + '.tmp'
+
+    row_count = 0
+    with pq.ParquetWriter(temporary_path, schema) as writer:
+        for chunk in pd.read_sas(data_source, format='sas7bdat', chunksize=chunk_size, encoding=encoding):
+            #empty SAS strings are missing values, as in spark-sas7bdat
+            chunk = chunk[column_names]
+            chunk = chunk.mask(chunk.isin(['']))
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            row_count += len(chunk)
+
+    os.replace(temporary_path, output_path)
+
+    return row_count
@@ -0,0 +1,133 @@
+"""
+Sketches of the fact table for approximate arrival queries.
+
+Sketches are built from the fact table joined with US ports and stored as small side tables:
+    sketch_arrivals - count-min sketches of arrivals by state name and by city key, an estimated count is never
+                      lower than the true count and exceeds it by at most eps * total_count with given confidence
+    sketch_port_visitors - approximate number of distinct visitors (cicid) per port, HyperLogLog++ with relative
+                           standard deviation rsd
+    sketch_stay_quantiles - approximate quantiles of stay per state, rank error is at most 1 / accuracy
+    sketch_temperatures - moments of temperature in a Bernoulli sample of arrivals per city, averages are reported
+                          with 95% confidence interval from the sample standard error
+Approximate queries read only these side tables, never the fact table.
+"""
+
+import math
+
+from pyspark.sql.functions import approx_count_distinct, broadcast, count, expr, lit, sum as sum_
+
+
+#quantiles of stay kept per state
+STAY_QUANTILES = [0.5, 0.9, 0.99]
+
+#normal quantile of 95% confidence interval
+Z_95 = 1.96
+
+
+def build_sketches(spark, df_visits, df_ports, eps=0.001, confidence=0.99, rsd=0.02, accuracy=10000, sample_fraction=0.05, seed=42):
+    """
+    This function:
+        Build sketches of arrivals, distinct visitors, stay and temperatures from the fact table
+    Paramters:
+        spark (object) - Spark session
+        df_visits (dataframe) - visits from fact table
+        df_ports (dataframe) - US ports from dimension table
+        eps (float) - relative error of count-min sketches
+        confidence (float) - confidence of count-min sketch error bound
+        rsd (float) - relative standard deviation of distinct visitor counts
+        accuracy (int) - accuracy of stay quantiles
+        sample_fraction (float) - sampled fraction of arrivals used for temperature averages
+        seed (int) - random seed
+    Returns:
+        dictionary of sketch dataframes by side table name
+    """
+
+    df_joined = df_visits.join(broadcast(df_ports.select('port_key', 'state', 'state_name', 'city', 'city_key')), 'port_key', how='inner')
+
+    #count-min sketches are built on JVM side, PySpark does not expose them
+    sketch_rows = []
+    for column in ['state_name', 'city_key']:
+        sketch = df_joined._jdf.stat().countMinSketch(column, eps, confidence, seed)
+        sketch_rows.append((column, bytearray(sketch.toByteArray()), eps, confidence, sketch.totalCount()))
+
+    df_arrivals = spark.createDataFrame(sketch_rows, 'sketch_column string, sketch binary, eps double, confidence double, total_count bigint')
+
+    df_port_visitors = df_visits.groupBy('port_key').agg(approx_count_distinct('cicid', rsd).alias('approx_visitors')) \
+                                .withColumn('rsd', lit(rsd))
+
+    df_stay_quantiles = df_joined.groupBy('state', 'state_name') \
+                                 .agg(expr('percentile_approx(stay, array({}), {})'.format(', '.join(map(str, STAY_QUANTILES)), accuracy)).alias('stay_quantiles')) \
+                                 .withColumn('accuracy', lit(accuracy))
+
+    #sums of temperatures and their squares can be rolled up from cities to states
+    df_temperatures = df_joined.sample(False, sample_fraction, seed) \
+                               .groupBy('state', 'state_name', 'city', 'city_key') \
+                               .agg(count('avgtemperature').alias('sample_count'),
+                                    sum_('avgtemperature').alias('temperature_sum'),
+                                    sum_(expr('avgtemperature * avgtemperature')).alias('temperature_sum_squares')) \
+                               .withColumn('sample_fraction', lit(sample_fraction))
+
+    return {'sketch_arrivals': df_arrivals,
+            'sketch_port_visitors': df_port_visitors,
+            'sketch_stay_quantiles': df_stay_quantiles,
+            'sketch_temperatures': df_temperatures}
+
+
+def get_arrival_estimator(spark, df_arrivals, sketch_column):
+    """
+    This function:
+        Get estimator of arrivals from count-min sketch
+    Paramters:
+        spark (object) - Spark session
+        df_arrivals (dataframe) - sketch_arrivals side table
+        sketch_column (string) - column the sketch was built on, 'state_name' or 'city_key'
+    Returns:
+        tuple of function returning estimated arrivals of column value and error bound with its confidence
+    """
+
+    row = df_arrivals.filter(df_arrivals.sketch_column == sketch_column).first()
+    sketch = spark._jvm.org.apache.spark.util.sketch.CountMinSketch.readFrom(bytearray(row.sketch))
+
+    return sketch.estimateCount, (math.ceil(row.eps * row.total_count), row.confidence)
+
+
+def get_approximate_arrivals(spark, df_arrivals, df_temperatures, group_column, state_code=None):
+    """
+    This function:
+        Estimate arrivals and average temperature by state or city from sketches
+    Paramters:
+        spark (object) - Spark session
+        df_arrivals (dataframe) - sketch_arrivals side table
+        df_temperatures (dataframe) - sketch_temperatures side table
+        group_column (string) - 'state_name' or 'city'
+        state_code (string) - if set, only cities of the state are returned
+    Returns:
+        pandas dataframe with group column, avg_temperature, avg_temperature_error, count and count_error,
+        groups without sampled arrivals are missing
+    """
+
+    if state_code is not None:
+        df_temperatures = df_temperatures.filter(df_temperatures.state == state_code)
+
+    #side table is small, it is rolled up on driver
+    temperatures = df_temperatures.toPandas()
+    key_column = 'state_name' if group_column == 'state_name' else 'city_key'
+
+    group_columns = [group_column] if key_column == group_column else [group_column, key_column]
+
+    df_groups = temperatures.groupby(group_columns, as_index=False)[['sample_count', 'temperature_sum', 'temperature_sum_squares']].sum()
+
+    mean = df_groups['temperature_sum'] / df_groups['sample_count']
+    variance = (df_groups['temperature_sum_squares'] / df_groups['sample_count'] - mean ** 2) * df_groups['sample_count'] / (df_groups['sample_count'] - 1)
+    df_groups['avg_temperature'] = mean.round(2)
+    df_groups['avg_temperature_error'] = (Z_95 * (variance.clip(lower=0) / df_groups['sample_count']) ** 0.5).round(2)
+
+    #cities of the same name in a state have one key, so estimates are not summed twice
+    estimate_count, (count_error, confidence) = get_arrival_estimator(spark, df_arrivals, key_column)
+    df_groups['count'] = [estimate_count(value.item() if hasattr(value, 'item') else value) for value in df_groups[key_column]]
+    df_groups['count_error'] = count_error
+
+    print('Arrival counts overestimate by at most {} with probability {}, temperatures are 95% confidence intervals from a sample'
+          .format(count_error, confidence))
+
+    return df_groups[[group_column, 'avg_temperature', 'avg_temperature_error', 'count', 'count_error']]
@@ -0,0 +1,44 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#pipeline modules read project.cfg and mapping files relative to the project folder
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+@pytest.fixture(scope='session')
+def spark():
+    """
+    Local Spark session shared by all tests, chunked SAS reader is used so no Spark package has to be resolved
+    """
+
+    pytest.importorskip('pyspark')
+    import etl
+
+    etl.sas_reader = 'chunked'
+    spark = etl.create_spark_session('local-dev')
+
+    yield spark
+
+    spark.stop()
+
+
+@pytest.fixture
+def workspace(spark, tmp_path, monkeypatch):
+    """
+    Input folder with mapping files and empty output folder of one test, pipeline paths point to them during the test
+    """
+
+    import etl
+
+    shutil.copytree(os.path.join(ROOT, 'project_input', 'map'), str(tmp_path / 'input' / 'map'))
+    monkeypatch.setattr(etl, 'input_data', str(tmp_path / 'input'))
+    monkeypatch.setattr(etl, 'output_data', str(tmp_path / 'output'))
+
+    return tmp_path
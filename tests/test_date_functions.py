@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('pyspark')
+
+from pyspark.sql.functions import udf
+
+import etl
+
+
+#former row-at-a-time Python UDFs of build_fact_i94_visits, native expressions must return the same values
+legacy_get_date_from_sas = udf(lambda x: (datetime(1960, 1, 1).date() + timedelta(x)).isoformat() if x else None)
+legacy_get_date = udf(lambda x, y, z: (datetime(x, y, z).date()).isoformat())
+legacy_get_stay = udf(lambda x, y: int(x - y))
+
+
+def get_mismatch_count(df, legacy_column, native_column):
+    return df.filter(~df[legacy_column].eqNullSafe(df[native_column].cast('string'))).count()
+
+
+def test_get_date_from_sas_and_get_stay(spark):
+    #SAS dates including null and zero, which is treated as missing date
+    rows = [(float(day), float(day + stay)) for day in range(20545, 20575) for stay in range(0, 40, 7)] + \
+           [(None, 20550.0), (20550.0, None), (0.0, 20550.0), (20550.0, 0.0), (None, None)]
+    df_dates = spark.createDataFrame(rows, 'arrdate double, depdate double')
+
+    df = df_dates.select(legacy_get_date_from_sas(df_dates.arrdate).alias('legacy_arrdate'), etl.get_date_from_sas('arrdate').alias('arrdate'),
+                         legacy_get_date_from_sas(df_dates.depdate).alias('legacy_depdate'), etl.get_date_from_sas('depdate').alias('depdate'))
+
+    assert df.filter(df.arrdate.isNull()).count() == 3
+    assert get_mismatch_count(df, 'legacy_arrdate', 'arrdate') == 0
+    assert get_mismatch_count(df, 'legacy_depdate', 'depdate') == 0
+
+    #legacy stay UDF fails on missing dates, stage table has no rows with missing departure date
+    df_known = df_dates.na.drop()
+    df = df_known.select(legacy_get_stay(df_known.depdate, df_known.arrdate).alias('legacy_stay'),
+                         etl.get_stay(df_known.depdate, df_known.arrdate).alias('stay'))
+
+    assert get_mismatch_count(df, 'legacy_stay', 'stay') == 0
+
+
+def test_get_date(spark):
+    rows = [(year, month, day) for year in [2015, 2016] for month in range(1, 13) for day in [1, 9, 10, 28]]
+    df_parts = spark.createDataFrame(rows, 'year int, month int, day int')
+
+    df = df_parts.select(legacy_get_date(df_parts.year, df_parts.month, df_parts.day).alias('legacy_date'),
+                         etl.get_date(df_parts.year, df_parts.month, df_parts.day).alias('date'))
+
+    assert df.filter(df.date.isNull()).count() == 0
+    assert get_mismatch_count(df, 'legacy_date', 'date') == 0
+
+
+def test_get_date_of_invalid_parts(spark):
+    df_parts = spark.createDataFrame([(2016, 2, 30), (2016, 13, 1)], 'year int, month int, day int')
+
+    assert df_parts.select(etl.get_date(df_parts.year, df_parts.month, df_parts.day).alias('date')).filter('date is not null').count() == 0
@@ -0,0 +1,140 @@
+import sys
+import threading
+
+import pytest
+
+import pipeline
+from pipeline import Stage, run_pipeline
+
+
+#module globals read by stage functions below, like settings read from configuration by pipeline stages
+ROW_LIMIT = 10
+UNUSED_SETTING = 'a'
+
+
+def limit_rows(rows):
+    return rows[:ROW_LIMIT]
+
+
+def load_rows(rows):
+    return limit_rows(rows)
+
+
+def load_rows_nested(rows):
+    def load():
+        return limit_rows(rows)
+    return load()
+
+
+def run(stages, state=None, fingerprints=None, existing=None, max_workers=4):
+    fingerprints = fingerprints or {}
+    state = {} if state is None else state
+    return run_pipeline(stages, fingerprints.get, lambda name: existing is None or name in existing, state, max_workers)
+
+
+def test_stages_run_after_their_upstream_stages():
+    order = []
+    stages = [
+        Stage('fact', lambda: order.append('fact'), inputs=['stage_a', 'stage_b'], outputs=['fact']),
+        Stage('a', lambda: order.append('a'), inputs=['file:a'], outputs=['stage_a']),
+        Stage('b', lambda: order.append('b'), inputs=['file:b'], outputs=['stage_b']),
+        Stage('agg', lambda: order.append('agg'), inputs=['fact'], outputs=['agg'])
+    ]
+
+    results = run(stages)
+
+    assert set(results) == {'fact', 'a', 'b', 'agg'}
+    assert order.index('fact') > max(order.index('a'), order.index('b'))
+    assert order.index('agg') > order.index('fact')
+
+
+def test_independent_stages_run_concurrently():
+    barrier = threading.Barrier(2, timeout=10)
+    stages = [Stage(name, barrier.wait, outputs=[name]) for name in ['a', 'b']]
+
+    assert set(run(stages, max_workers=2)) == {'a', 'b'}
+
+
+def test_cyclic_dependencies_are_rejected_before_any_stage_runs():
+    calls = []
+    stages = [
+        Stage('a', lambda: calls.append('a'), inputs=['b_out'], outputs=['a_out']),
+        Stage('b', lambda: calls.append('b'), inputs=['a_out'], outputs=['b_out']),
+        Stage('c', lambda: calls.append('c'), outputs=['c_out'])
+    ]
+
+    with pytest.raises(ValueError, match='cyclic'):
+        run(stages)
+    assert calls == []
+
+
+def test_output_written_by_two_stages_is_rejected():
+    stages = [Stage('a', lambda: None, outputs=['table']), Stage('b', lambda: None, outputs=['table'])]
+
+    with pytest.raises(ValueError, match='written by stages'):
+        run(stages)
+
+
+def test_unchanged_stages_are_skipped():
+    calls = []
+    fingerprints = {'file:a': 1}
+    stages = [
+        Stage('a', lambda: calls.append('a'), inputs=['file:a'], outputs=['stage_a']),
+        Stage('fact', lambda: calls.append('fact'), inputs=['stage_a'], outputs=['fact'])
+    ]
+    state = {}
+
+    run(stages, state, fingerprints)
+    assert run(stages, state, fingerprints) == {}
+    assert calls == ['a', 'fact']
+
+    #changed input reruns the stage, its output fingerprint changes, so downstream stage reruns too
+    fingerprints.update({'file:a': 2, 'stage_a': 2})
+    assert set(run(stages, state, fingerprints)) == {'a', 'fact'}
+
+    #missing output reruns the stage even if inputs and code have not changed
+    assert set(run(stages, state, fingerprints, existing={'stage_a'})) == {'fact'}
+
+
+def test_failed_stage_stops_pipeline_and_keeps_state_of_finished_stages():
+    calls = []
+
+    def fail():
+        raise IOError('disk full')
+
+    stages = [
+        Stage('a', lambda: calls.append('a'), outputs=['stage_a']),
+        Stage('b', fail, outputs=['stage_b']),
+        Stage('fact', lambda: calls.append('fact'), inputs=['stage_a', 'stage_b'], outputs=['fact'])
+    ]
+    state = {}
+
+    with pytest.raises(RuntimeError, match='"b" has failed') as error:
+        run(stages, state)
+
+    assert isinstance(error.value.__cause__, IOError)
+    assert 'fact' not in calls
+    assert set(state) == {'a'}
+
+
+def test_code_fingerprint_follows_called_functions_and_read_globals(monkeypatch):
+    stage = Stage('load', load_rows, args=('object',), outputs=['rows'])
+    nested_stage = Stage('load', load_rows_nested, outputs=['rows'])
+    fingerprint = stage.get_code_fingerprint()
+    nested_fingerprint = nested_stage.get_code_fingerprint()
+
+    sources, values = pipeline.get_code_references(load_rows)
+    assert any(name.endswith('.limit_rows') for name in sources)
+    assert not any(name.endswith('.run') for name in sources)
+
+    monkeypatch.setattr(sys.modules[__name__], 'UNUSED_SETTING', 'b')
+    assert stage.get_code_fingerprint() == fingerprint
+
+    monkeypatch.setattr(sys.modules[__name__], 'ROW_LIMIT', 20)
+    assert stage.get_code_fingerprint() != fingerprint
+    assert nested_stage.get_code_fingerprint() != nested_fingerprint
+
+
+def test_code_fingerprint_includes_plain_arguments():
+    assert Stage('load', load_rows, args=(1,)).get_code_fingerprint() != Stage('load', load_rows, args=(2,)).get_code_fingerprint()
+    assert Stage('load', load_rows, args=(object(),)).get_code_fingerprint() == Stage('load', load_rows, args=(object(),)).get_code_fingerprint()
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+pytest.importorskip('pyspark')
+
+import etl
+import generate_data
+
+
+def test_stage_city_temperature_data(spark, workspace):
+    generate_data.generate_city_temperatures(spark, '2016-04', '2016-04', 1, os.path.join(etl.input_data, 'city_temperature.csv'))
+
+    etl.stage_city_temperature_data(spark, 'city_temperature.csv', 'stage_city_temperatures', '2016-04', '2016-04')
+
+    df = spark.read.parquet(os.path.join(etl.output_data, 'stage_city_temperatures'))
+    assert df.count() > 0
+    assert df.filter(df.country != 'US').count() == 0
+    assert df.filter(df.city_key.isNull() | df.date_key.isNull()).count() == 0
+    etl.check_table_schemas(spark, {'stage_city_temperatures': etl.EXPECTED_SCHEMAS['stage_city_temperatures']})
+
+
+def test_build_fact_i94_visits(spark, workspace):
+    data_sources = generate_data.generate_dataset(spark, etl.input_data, '2016-04', '2016-04', 2000, world_scale=1)
+
+    etl.stage_i94_months(spark, data_sources, 'stage_i94_immigration')
+    etl.stage_city_temperature_data(spark, 'city_temperature.csv', 'stage_city_temperatures', '2016-04', '2016-04')
+    etl.load_dim_us_ports(spark, 'map/I94-us_ports.txt', 'map/I94-us_states.txt', 'dim_us_ports')
+    etl.build_fact_i94_visits(spark, 'stage_i94_immigration', 'stage_city_temperatures', 'dim_us_ports', 'fact_i94_visits')
+
+    df = spark.read.parquet(os.path.join(etl.output_data, 'fact_i94_visits'))
+    assert df.count() > 0
+    assert df.filter(df.avgtemperature.isNull()).count() == 0
+    etl.check_table_schemas(spark, {table_name: etl.EXPECTED_SCHEMAS[table_name] 
+                                    for table_name in ['stage_i94_immigration', 'stage_city_temperatures', 'dim_us_ports', 'fact_i94_visits']})
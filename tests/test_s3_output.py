@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pyspark = pytest.importorskip('pyspark')
+pytest.importorskip('moto')
+pytest.importorskip('boto3')
+
+from conftest import ROOT
+
+
+@pytest.mark.skipif(tuple(int(part) for part in pyspark.__version__.split('.')[:2]) < (3, 2), reason='S3A committers need Spark 3.2 or later')
+def test_s3a_output_against_moto():
+    #S3A committer classes are loaded when the JVM starts, so checks run in own process with own Spark session
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 's3_harness.py')], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
+                            universal_newlines=True, timeout=900)
+    check_lines = [line for line in result.stdout.splitlines() if line.startswith(('PASS ', 'FAIL '))]
+
+    assert result.returncode == 0, '\n'.join(check_lines) or result.stdout[-5000:]
+    assert len(check_lines) == 5 and all(line.startswith('PASS ') for line in check_lines)